@@ -102,6 +102,12 @@ class Adapter(nn.Module):
 
         return output
 
+    def momentum_parameters(self):
+        # the parameters blended with the running mean of the previous tasks' adapters
+        return [self.down_proj.weight, self.down_proj.bias, self.up_proj.weight, self.up_proj.bias,
+                self.attention.in_proj_weight, self.attention.in_proj_bias,
+                self.attention.out_proj.weight, self.attention.out_proj.bias]
+
 
 # class Adapter(nn.Module):
 #     def __init__(self,
@@ -252,6 +258,29 @@ class Block(nn.Module):
 
         return x
 
+    def forward_routes(self, x, adapts, splits):
+        # x stacks several routes along the batch dimension, chunk i of size splits[i] uses adapts[i] (None: no adapter)
+        x = x + self.drop_path(self.attn(self.norm1(x)))
+        adapt_xs = [adapt(chunk, add_residual=False) if adapt is not None else None
+                    for adapt, chunk in zip(adapts, x.split(splits))]
+
+        residual = x
+        x = self.mlp_drop(self.act(self.fc1(self.norm2(x))))
+        x = self.drop_path(self.mlp_drop(self.fc2(x)))
+
+        chunks = list(x.split(splits))
+        for i, (adapt, adapt_x) in enumerate(zip(adapts, adapt_xs)):
+            if adapt_x is not None and self.config.ffn_adapt:
+                if self.config.ffn_option == 'sequential':
+                    chunks[i] = adapt(chunks[i])
+                elif self.config.ffn_option == 'parallel':
+                    chunks[i] = chunks[i] + adapt_x
+                else:
+                    raise ValueError(self.config.ffn_adapt)
+
+        x = residual + torch.cat(chunks, dim=0)
+
+        return x
 
 
 class VisionTransformer(nn.Module):
@@ -330,16 +359,17 @@ class VisionTransformer(nn.Module):
         self.config = tuning_config
         self._device = tuning_config._device
         self.adapter_list = nn.ModuleList()
+        self.adapter_bank = nn.ModuleList() # frozen momentum-blended adapters used at inference, one per task
         self.cur_adapter = nn.ModuleList()
         
-        self.down_weight_sum = [[] for i in range(len(self.blocks))] # prefix sum of the adapter weights
-        self.down_bias_sum = [[] for i in range(len(self.blocks))]
-        self.up_weight_sum = [[] for i in range(len(self.blocks))]
-        self.up_bias_sum = [[] for i in range(len(self.blocks))]
-        self.attn_weight_sum =  [[] for i in range(len(self.blocks))]
-        self.attn_bias_sum=  [[] for i in range(len(self.blocks))]
-        self.attn_out_weight_sum =  [[] for i in range(len(self.blocks))]
-        self.attn_out_bias_sum =  [[] for i in range(len(self.blocks))]         
+        # running sum of the momentum parameters of the stored adapters, one flat buffer per layer
+        # (constant memory; reweight_adapter only ever needs the mean over all stored adapters)
+        self.adapter_param_sum = []
+        self.adapter_sum_count = 0
+        self.adapter_param_mean = None
+        # the momentum parameters of cur_adapter are views into one flat buffer, see flat_cur_adapter
+        self._cur_adapter_flat = None
+        self._cur_adapter_views = []
         
         self.init_adapters()
 
@@ -386,11 +416,55 @@ class VisionTransformer(nn.Module):
         if len(self.adapter_list) == 0 or adapter_momentum == 0:
             pass
         else:   
-            self.cur_adapter = self.reweight_adapter(self.cur_adapter, len(self.adapter_list))
+            self.blend_cur_adapter(len(self.adapter_list))
+
+    def flat_cur_adapter(self):
+        """
+        Flat buffer holding the momentum parameters of every layer of cur_adapter, in the order of adapter_param_sum.
+        The parameters are made views into it, so a blend of the whole adapter is one vector op; the buffer is
+        rebuilt if a parameter has been rebound since (e.g. by reweight_adapter).
+        """
+        params = [p for layer in self.cur_adapter for p in layer.momentum_parameters()]
+        if self._cur_adapter_flat is not None and len(params) == len(self._cur_adapter_views) \
+                and all(p.data_ptr() == v.data_ptr() for p, v in zip(params, self._cur_adapter_views)):
+            return self._cur_adapter_flat
+        flat = torch.cat([p.data.reshape(-1) for p in params])
+        views, offset = [], 0
+        for p in params:
+            view = flat[offset:offset + p.numel()].view_as(p)
+            p.data = view
+            views.append(view)
+            offset += p.numel()
+        self._cur_adapter_flat, self._cur_adapter_views = flat, views
+        return flat
+
+    @torch.no_grad()
+    def blend_cur_adapter(self, idx, steps=1):
+        # same as `steps` calls of reweight_adapter(self.cur_adapter, idx), fused into one lerp of the flat buffer
+        momentum = self.config.adapter_momentum
+        if momentum == 0 or idx == 0:
+            return
+        if idx != self.adapter_sum_count:
+            raise ValueError("The running sum covers {} adapters, cannot blend adapter {}.".format(self.adapter_sum_count, idx))
+        self.flat_cur_adapter().lerp_(self.adapter_param_mean, 1 - (1 - momentum) ** steps)
+
+    def forward_blend(self, adapter_id):
+        # every forward through cur_adapter blends it toward the running mean once per block,
+        # applied up front as one fused op, so forward_features and forward_routes see the same weights
+        self.blend_cur_adapter(adapter_id, steps=len(self.blocks))
 
     def adapter_update(self):
         self.adapter_list.append(copy.deepcopy(self.cur_adapter))
+        # stored adapters never change again, so only the new task's entry has to be materialized,
+        # blended with the mean of the previous adapters before it is added to the running sum
+        self.adapter_bank.append(self.materialize_adapter(len(self.adapter_list) - 1))
         self.sum_adapter_param()
+
+    def materialize_adapter(self, idx):
+        # blend the stored adapter with the running mean of the previous ones once, without touching adapter_list
+        # always a copy, so the bank never aliases the weights of adapter_list
+        adapter = self.reweight_adapter(copy.deepcopy(self.adapter_list[idx]), idx)
+        return adapter.requires_grad_(False).eval()
     
     # Calculate the prefix sum of the adapters.
     # def sum_adapter_param(self):      
@@ -406,30 +480,16 @@ class VisionTransformer(nn.Module):
     #             self.up_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].up_proj.weight.data)
     #             self.up_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].up_proj.bias.data)
 
-    def sum_adapter_param(self):      
+    def sum_adapter_param(self):
         for layer_idx in range(len(self.blocks)):
-            if len(self.down_weight_sum[layer_idx]) > 0:
-                self.down_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].down_proj.weight.data + self.down_weight_sum[layer_idx][-1])
-                self.down_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].down_proj.bias.data + self.down_bias_sum[layer_idx][-1])
-                self.up_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].up_proj.weight.data + self.up_weight_sum[layer_idx][-1])
-                self.up_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].up_proj.bias.data + self.up_bias_sum[layer_idx][-1])
-    
-                # Track Attention Weights
-                self.attn_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.in_proj_weight.data + self.attn_weight_sum[layer_idx][-1])
-                self.attn_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.in_proj_bias.data + self.attn_bias_sum[layer_idx][-1])
-                self.attn_out_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.out_proj.weight.data + self.attn_out_weight_sum[layer_idx][-1])
-                self.attn_out_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.out_proj.bias.data + self.attn_out_bias_sum[layer_idx][-1])
+            # torch.cat copies, so the sum is a snapshot and never aliases the live parameters
+            flat = torch.cat([p.data.reshape(-1) for p in self.cur_adapter[layer_idx].momentum_parameters()])
+            if layer_idx < len(self.adapter_param_sum):
+                self.adapter_param_sum[layer_idx] += flat
             else:
-                self.down_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].down_proj.weight.data)
-                self.down_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].down_proj.bias.data)
-                self.up_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].up_proj.weight.data)
-                self.up_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].up_proj.bias.data)
-    
-                # Initialize Attention Sums
-                self.attn_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.in_proj_weight.data)
-                self.attn_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.in_proj_bias.data)
-                self.attn_out_weight_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.out_proj.weight.data)
-                self.attn_out_bias_sum[layer_idx].append(self.cur_adapter[layer_idx].attention.out_proj.bias.data)
+                self.adapter_param_sum.append(flat)
+        self.adapter_sum_count += 1
+        self.adapter_param_mean = torch.cat(self.adapter_param_sum) / self.adapter_sum_count
 
     # def reweight_adapter(self, adapter, idx):
     #     # adapter: original adapter
@@ -455,27 +515,16 @@ class VisionTransformer(nn.Module):
         momentum = self.config.adapter_momentum
         if momentum == 0 or idx == 0:
             return adapter
+        if idx != self.adapter_sum_count:
+            raise ValueError("The running sum covers {} adapters, cannot blend adapter {}.".format(self.adapter_sum_count, idx))
     
         for layer_idx in range(len(self.blocks)):
-            # Reweight down and up projections
-            adapter[layer_idx].down_proj.weight.data = (1 - momentum) * adapter[layer_idx].down_proj.weight.data \
-                                                                     + momentum * self.down_weight_sum[layer_idx][idx-1] / idx
-            adapter[layer_idx].down_proj.bias.data = (1 - momentum) * adapter[layer_idx].down_proj.bias.data \
-                                                                     + momentum * self.down_bias_sum[layer_idx][idx-1] / idx
-            adapter[layer_idx].up_proj.weight.data = (1 - momentum) * adapter[layer_idx].up_proj.weight.data \
-                                                                     + momentum * self.up_weight_sum[layer_idx][idx-1] / idx
-            adapter[layer_idx].up_proj.bias.data = (1 - momentum) * adapter[layer_idx].up_proj.bias.data \
-                                                                     + momentum * self.up_bias_sum[layer_idx][idx-1] / idx
-    
-            # Reweight Attention Weights
-            adapter[layer_idx].attention.in_proj_weight.data = (1 - momentum) * adapter[layer_idx].attention.in_proj_weight.data \
-                                                                         + momentum * self.attn_weight_sum[layer_idx][idx-1] / idx
-            adapter[layer_idx].attention.in_proj_bias.data = (1 - momentum) * adapter[layer_idx].attention.in_proj_bias.data \
-                                                                         + momentum * self.attn_bias_sum[layer_idx][idx-1] / idx
-            adapter[layer_idx].attention.out_proj.weight.data = (1 - momentum) * adapter[layer_idx].attention.out_proj.weight.data \
-                                                                         + momentum * self.attn_out_weight_sum[layer_idx][idx-1] / idx
-            adapter[layer_idx].attention.out_proj.bias.data = (1 - momentum) * adapter[layer_idx].attention.out_proj.bias.data \
-                                                                         + momentum * self.attn_out_bias_sum[layer_idx][idx-1] / idx
+            params = adapter[layer_idx].momentum_parameters()
+            mean = (self.adapter_param_sum[layer_idx] / idx).split([p.numel() for p in params])
+            for param, param_mean in zip(params, mean):
+                # autograd saves leaf parameters themselves, not a copy, so blends must only run before the forward
+                # or after optimizer.step(), never between a forward and its backward
+                param.data = (1 - momentum) * param.data + momentum * param_mean.view_as(param)
         
         return adapter
 
@@ -556,24 +605,17 @@ class VisionTransformer(nn.Module):
         if adapter_id == -1:
             x = self.blocks(x)
         else:
+            if train or adapter_id == len(self.adapter_list):
+                self.forward_blend(adapter_id)
             for layer_idx, blk in enumerate(self.blocks):
                 if train:
-                    orig_adapter = self.cur_adapter
-                    momentum_adapter = self.reweight_adapter(orig_adapter, adapter_id)
-                    
-                    x = blk(x, momentum_adapter[layer_idx])
+                    x = blk(x, self.cur_adapter[layer_idx])
                 else:
                     if adapter_id == len(self.adapter_list):
-                        orig_adapter = self.cur_adapter
-                        momentum_adapter = self.reweight_adapter(orig_adapter, adapter_id)
-                        
-                        x = blk(x, momentum_adapter[layer_idx])
-
-                    elif adapter_id < len(self.adapter_list):
-                        orig_adapter = self.adapter_list[adapter_id]
-                        momentum_adapter = self.reweight_adapter(orig_adapter, adapter_id)
-                        
-                        x = blk(x, momentum_adapter[layer_idx])
+                        x = blk(x, self.cur_adapter[layer_idx])
+
+                    elif adapter_id < len(self.adapter_bank):
+                        x = blk(x, self.adapter_bank[adapter_id][layer_idx])
                     else:
                         raise ValueError("adapter_id is wrong.")
 
@@ -591,6 +633,60 @@ class VisionTransformer(nn.Module):
         
         return res
 
+    def inference_adapter(self, adapter_id):
+        if adapter_id == -1:
+            return None
+        elif adapter_id < len(self.adapter_bank):
+            return self.adapter_bank[adapter_id]
+        elif adapter_id == len(self.adapter_list):
+            self.forward_blend(adapter_id)
+            return self.cur_adapter
+        else:
+            raise ValueError("adapter_id is wrong.")
+
+    def forward_routes(self, x, routes):
+        """
+        Eval forward of several adapter routes in one pass.
+
+        The stem (patch embedding, cls token, positional embedding) runs once, then the tokens of all routes
+        are stacked along the batch so every frozen block runs as one large batch and only the adapters
+        are applied per route.
+
+        Args:
+            x (torch.Tensor): Input images [B, C, H, W]
+            routes (list): (adapter_id, sample_idx) pairs. adapter_id -1 is the plain pretrained ViT,
+                sample_idx None selects the whole batch.
+
+        Returns:
+            list: Features [len(sample_idx), embed_dim] for each route.
+        """
+        B = x.shape[0]
+        x = self.patch_embed(x)
+
+        cls_tokens = self.cls_token.expand(B, -1, -1)
+        x = torch.cat((cls_tokens, x), dim=1)
+        x = x + self.pos_embed
+        x = self.pos_drop(x)
+
+        adapters, tokens = [], []
+        for adapter_id, sample_idx in routes:
+            adapters.append(self.inference_adapter(adapter_id))
+            tokens.append(x if sample_idx is None else x[sample_idx])
+        splits = [t.shape[0] for t in tokens]
+        x = torch.cat(tokens, dim=0)
+
+        for layer_idx, blk in enumerate(self.blocks):
+            x = blk.forward_routes(x, [None if a is None else a[layer_idx] for a in adapters], splits)
+
+        if self.global_pool:
+            x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
+            outcome = self.fc_norm(x)
+        else:
+            x = self.norm(x)
+            outcome = x[:, 0]
+
+        return list(outcome.split(splits))
+
     def forward_head(self, res):
         x = res['x']
 
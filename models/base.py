@@ -3,14 +3,32 @@ import logging
 import numpy as np
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
-from utils.toolkit import tensor2numpy, accuracy, f1_score_custom, mcc_score_custom,kappa_score_custom, balanced_accuracy_custom
+from utils.toolkit import tensor2numpy, ConfusionMetrics
 from scipy.spatial.distance import cdist
 from sklearn.metrics import f1_score, matthews_corrcoef, cohen_kappa_score, balanced_accuracy_score
 
 EPSILON = 1e-8
 batch_size = 64
 
+
+class EvalResult(object):
+    """
+    Predictions of a single inference sweep over the test set, from which any number of metrics can be computed.
+    """
+    def __init__(self, y_pred, y_true, nme_pred=None, nme_true=None):
+        self.y_pred = y_pred  # [N, topk]
+        self.y_true = y_true  # [N]
+        self.nme_pred = nme_pred
+        self.nme_true = nme_true
+        self._confusion = None
+
+    @property
+    def confusion(self):
+        # built once and shared by every metric scored from this result
+        if self._confusion is None:
+            self._confusion = ConfusionMetrics(self.y_pred.T[0], self.y_true)
+        return self._confusion
+
 class BaseLearner(object):
     def __init__(self, args):
         self._cur_task = -1
@@ -63,7 +81,7 @@ class BaseLearner(object):
         print('now draw tsne results of extracted features.')
         tot_classes=self._total_classes
         test_dataset = self.data_manager.get_dataset(np.arange(0, tot_classes), source='test', mode='test')
-        valloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+        valloader = self.data_manager.loader(test_dataset, batch_size=batch_size, shuffle=False)
         vectors, y_true = self._extract_vectors(valloader)
         if showcenters:
             fc_weight=self._network.fc.proj.cpu().detach().numpy()[:tot_classes]
@@ -113,25 +131,18 @@ class BaseLearner(object):
 
     #     return ret
 
-    def _evaluate(self, y_pred, y_true, metric="accuracy"):
+    def _evaluate(self, y_pred, y_true, metric="accuracy", confusion=None):
         ret = {}
         
-        # Define a dictionary of available metrics
-        metric_functions = {
-            "accuracy": accuracy,
-            "f1_score": f1_score_custom,
-            "mcc": mcc_score_custom,
-            "kappa": kappa_score_custom,
-            "balanced_accuracy": balanced_accuracy_custom
-        }
-        
         # Ensure the metric exists, otherwise default to accuracy
-        if metric not in metric_functions:
+        if metric not in ConfusionMetrics.METRICS:
             print(f"Warning: Metric '{metric}' not found. Defaulting to 'accuracy'.")
             metric = "accuracy"
     
-        # Compute the selected metric
-        grouped = metric_functions[metric](y_pred.T[0], y_true, self._known_classes, self.args["init_cls"], self.args["increment"])
+        # Compute the selected metric from the confusion matrix of the top-1 predictions
+        if confusion is None:
+            confusion = ConfusionMetrics(y_pred.T[0], y_true)
+        grouped = confusion.grouped(metric, self._known_classes, self.args["init_cls"], self.args["increment"])
         
         ret["grouped"] = grouped
         ret["top1"] = grouped["total"]
@@ -163,17 +174,40 @@ class BaseLearner(object):
     
     #     return ret
 
-    def eval_task(self,metric):
+    def predict_task(self):
         y_pred, y_true = self._eval_cnn(self.test_loader)
-        cnn_accy = self._evaluate(y_pred, y_true,metric)
 
         if hasattr(self, "_class_means"):
-            y_pred, y_true = self._eval_nme(self.test_loader, self._class_means)
-            nme_accy = self._evaluate(y_pred, y_true)
+            nme_pred, nme_true = self._eval_nme(self.test_loader, self._class_means)
         else:
-            nme_accy = None
+            nme_pred, nme_true = None, None
+
+        return EvalResult(y_pred, y_true, nme_pred, nme_true)
+
+    def eval_task(self, metric="accuracy", result=None):
+        """
+        Parameters:
+            metric: A metric name, or a list of metric names.
+            result: An EvalResult to score. If None, inference is run once over the test set.
+
+        Returns:
+            (cnn_accy, nme_accy) for a single metric, or a dictionary mapping each metric to that pair.
+        """
+        if result is None:
+            result = self.predict_task()
+
+        # the NME score does not depend on the metric
+        nme_accy = None
+        if result.nme_pred is not None:
+            nme_accy = self._evaluate(result.nme_pred, result.nme_true)
+
+        metrics = [metric] if isinstance(metric, str) else metric
+        ret = {}
+        for name in metrics:
+            cnn_accy = self._evaluate(result.y_pred, result.y_true, name, result.confusion)
+            ret[name] = (cnn_accy, nme_accy)
 
-        return cnn_accy, nme_accy
+        return ret[metric] if isinstance(metric, str) else ret
 
     def incremental_train(self):
         pass
@@ -274,8 +308,8 @@ class BaseLearner(object):
             idx_dataset = data_manager.get_dataset(
                 [], source="train", mode="test", appendent=(dd, dt)
             )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
+            idx_loader = data_manager.loader(
+                idx_dataset, batch_size=batch_size, shuffle=False
             )
             vectors, _ = self._extract_vectors(idx_loader)
             vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
@@ -293,8 +327,8 @@ class BaseLearner(object):
                 mode="test",
                 ret_data=True,
             )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
+            idx_loader = data_manager.loader(
+                idx_dataset, batch_size=batch_size, shuffle=False
             )
             vectors, _ = self._extract_vectors(idx_loader)
             vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
@@ -345,8 +379,8 @@ class BaseLearner(object):
                 mode="test",
                 appendent=(selected_exemplars, exemplar_targets),
             )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
+            idx_loader = data_manager.loader(
+                idx_dataset, batch_size=batch_size, shuffle=False
             )
             vectors, _ = self._extract_vectors(idx_loader)
             vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
@@ -372,8 +406,8 @@ class BaseLearner(object):
             class_dset = data_manager.get_dataset(
                 [], source="train", mode="test", appendent=(class_data, class_targets)
             )
-            class_loader = DataLoader(
-                class_dset, batch_size=batch_size, shuffle=False, num_workers=4
+            class_loader = data_manager.loader(
+                class_dset, batch_size=batch_size, shuffle=False
             )
             vectors, _ = self._extract_vectors(class_loader)
             vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
@@ -390,8 +424,8 @@ class BaseLearner(object):
                 mode="test",
                 ret_data=True,
             )
-            class_loader = DataLoader(
-                class_dset, batch_size=batch_size, shuffle=False, num_workers=4
+            class_loader = data_manager.loader(
+                class_dset, batch_size=batch_size, shuffle=False
             )
 
             vectors, _ = self._extract_vectors(class_loader)
@@ -442,8 +476,8 @@ class BaseLearner(object):
                 mode="test",
                 appendent=(selected_exemplars, exemplar_targets),
             )
-            exemplar_loader = DataLoader(
-                exemplar_dset, batch_size=batch_size, shuffle=False, num_workers=4
+            exemplar_loader = data_manager.loader(
+                exemplar_dset, batch_size=batch_size, shuffle=False
             )
             vectors, _ = self._extract_vectors(exemplar_loader)
             vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
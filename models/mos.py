@@ -5,16 +5,16 @@ from torch import nn
 from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from utils.inc_net import MOSNet
 from models.base import BaseLearner
-from utils.toolkit import tensor2numpy, target2onehot
-from torch.distributions.multivariate_normal import MultivariateNormal
+from utils.toolkit import tensor2numpy, target2onehot, batched_kmeans
+from utils.feature_cache import FeatureStore, state_fingerprint
+from utils.class_stats import ClassStatsStore, GaussianFeatureSampler, RunningClassMoments
 import time
 
 
 # tune the model at first session with vpt, and then conduct simple shot.
-num_workers = 4
+orth_temperature = 0.8
 from collections import defaultdict
 
 
@@ -244,6 +244,43 @@ class MemoryTaskSelector(nn.Module):
 
 
 
+class EpochStats(object):
+    """
+    Per-epoch training statistics, accumulated on device and read back once at epoch end.
+    """
+    def __init__(self, num_classes, device):
+        self.loss_sum = torch.zeros((), device=device)
+        self.correct = torch.zeros((), dtype=torch.long, device=device)
+        self.total = 0
+        self.num_batches = 0
+        self.class_loss_sum = torch.zeros(num_classes, device=device)
+        self.class_counts = torch.zeros(num_classes, device=device)
+
+    @torch.no_grad()
+    def update(self, loss, ce_loss, logits, targets):
+        self.loss_sum += loss.sum()
+        self.correct += logits.argmax(dim=1).eq(targets).sum()
+        self.total += len(targets)
+        self.num_batches += 1
+        self.class_loss_sum.index_add_(0, targets, ce_loss.float())
+        self.class_counts.index_add_(0, targets, torch.ones_like(ce_loss, dtype=self.class_counts.dtype))
+
+    @property
+    def class_losses(self):
+        # mean cross-entropy per class (zero for classes without samples)
+        return self.class_loss_sum / (self.class_counts + 1e-8)
+
+    def summary(self):
+        """
+        Returns:
+            float: Mean loss per batch
+            float: Training accuracy in percent
+        """
+        loss = self.loss_sum.item() / max(self.num_batches, 1)
+        train_acc = np.around(self.correct.item() * 100 / max(self.total, 1), decimals=2)
+        return loss, train_acc
+
+
 class Learner(BaseLearner):
     def __init__(self, args):
         super().__init__(args)
@@ -251,6 +288,27 @@ class Learner(BaseLearner):
         self._network = MOSNet(args, True)
         self.cls_mean = dict()
         self.cls_cov = dict()
+        # 'low-rank' storage: rank of the kept eigenbasis, and whether one covariance is pooled over each task's classes
+        self.ca_rank = args.get("ca_rank", 64)
+        self.ca_pooled_cov = args.get("ca_pooled_cov", False)
+        self.task_cov = dict()
+        # contiguous matrix of all stored class means for orth_loss, refreshed by _compute_mean
+        self.proto_matrix = None
+        # stacked Gaussian components sampled by classifer_align (mean, scale factor, class label),
+        # extended with the new classes only since old class statistics do not change
+        self.ca_means, self.ca_scales, self.ca_labels = None, None, None
+        # low-rank storage only: residual std added to the factor term, and the factor of each component if shared
+        self.ca_diag, self.ca_scale_index = None, None
+        self.ca_factorized_classes = 0
+        # how classifer_align fits the head: "sgd" on sampled features, or in closed form ("ridge", "lda")
+        # from running moments of the stored Gaussians, updated with the new classes only
+        self.ca_solver = args.get("ca_solver", "sgd")
+        self.ca_solver_reg = args.get("ca_solver_reg", 1e-3)
+        self.ca_second_moment, self.ca_class_sum, self.ca_class_count = None, None, None
+        # where the large class statistics live once their task is over: "device", "host" (pinned) or "disk" (memmap)
+        self.class_stats_tier = args.get("class_stats_tier", "device")
+        self.class_stats_chunk = args.get("class_stats_chunk", 64)
+        self._stats_device = self._device if self.class_stats_tier == "device" else torch.device("cpu")
         self.cls2task = dict()
         self.batch_size = args["batch_size"]
         self.init_lr = args["init_lr"]
@@ -264,7 +322,17 @@ class Learner(BaseLearner):
         self.task_optimizer=optim.Adam(
                 self.task_selector.parameters(),
             )
-        self.eval_cnn_times = [] 
+        # diagnostic probes (e.g. the accuracy of the adapter-0 model) cost extra work per batch, so they are opt-in
+        self.diagnostics = args.get("diagnostics", False)
+        self.eval_diagnostics = defaultdict(list)  # metric name -> one value per _eval_cnn call
+        # persistent cache of pretrained-trunk features for the task selector, keyed by sample and transform
+        # and namespaced by the trunk weights (the parameters frozen below), so another checkpoint never reuses it
+        self.trunk_features = None
+        if args.get("feature_cache_dir"):
+            trunk = [(n, t) for n, t in self._network.backbone.state_dict().items() if 'adapter' not in n and 'head' not in n]
+            self.trunk_features = FeatureStore(args["feature_cache_dir"], (args["backbone_type"], state_fingerprint(trunk)))
+        # in-memory cache of test features per stored adapter, which are frozen once their task ends
+        self.adapter_features = FeatureStore(None, args["backbone_type"]) if args.get("adapter_feature_cache", False) else None
 
         
         for n, p in self._network.backbone.named_parameters():
@@ -282,28 +350,12 @@ class Learner(BaseLearner):
                 if param.requires_grad:
                     logging.info("{}: {}".format(name, param.numel()))
     
-    def replace_fc(self):       
-        model = self._network.to(self._device)
-        embedding_list = []
-        label_list = []
-        with torch.no_grad():
-            for i, batch in enumerate(self.train_loader_for_protonet):
-                (_,data, label) = batch
-                data = data.to(self._device)
-                label = label.to(self._device)
-                embedding = model.forward_orig(data)['features']
-                embedding_list.append(embedding.cpu())
-                label_list.append(label.cpu())
-        embedding_list = torch.cat(embedding_list, dim=0)
-        label_list = torch.cat(label_list, dim=0)
-        
-        class_list = np.unique(self.train_dataset.labels)
-        for class_index in class_list:
-            data_index = (label_list == class_index).nonzero().squeeze(-1)
-            embedding = embedding_list[data_index]
-            proto = embedding.mean(0)
-            self._network.fc.weight.data[class_index] = proto
-        return model
+    def replace_fc(self, prototypes, class_counts):
+        # prototypes [C_task, D] of the task's classes, computed by _compute_mean from the adapter-0 features
+        for i, class_index in enumerate(range(self._known_classes, self._total_classes)):
+            if class_counts[i] > 0:
+                self._network.fc.weight.data[class_index] = prototypes[i].to(self._network.fc.weight.dtype)
+        return self._network
 
     def after_task(self):
         self._known_classes = self._total_classes
@@ -315,26 +367,28 @@ class Learner(BaseLearner):
         
         for i in range(self._known_classes, self._total_classes):
             self.cls2task[i] = self._cur_task
+        # class -> task lookup for the task selector targets, indexed on device
+        self.cls2task_table = torch.tensor([self.cls2task[i] for i in range(self._total_classes)], dtype=torch.long, device=self._device)
         
         self._network.update_fc(self._total_classes)
         logging.info("Learning on {}-{}".format(self._known_classes, self._total_classes))
 
         self.train_dataset = data_manager.get_dataset(np.arange(self._known_classes, self._total_classes), source="train", mode="train")
         self.data_manager = data_manager
-        self.train_loader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=num_workers)
+        self.train_loader = data_manager.loader(self.train_dataset, batch_size=self.batch_size, shuffle=True)
         test_dataset = data_manager.get_dataset(np.arange(0, self._total_classes), source="test", mode="test" )
-        self.test_loader = DataLoader(test_dataset, batch_size=self.batch_size, shuffle=False, num_workers=num_workers)
+        self.test_loader = data_manager.loader(test_dataset, batch_size=self.batch_size, shuffle=False)
         
         train_dataset_for_protonet = data_manager.get_dataset(np.arange(self._known_classes, self._total_classes),source="train", mode="test")
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=self.batch_size, shuffle=True, num_workers=num_workers)
+        self.train_loader_for_protonet = data_manager.loader(train_dataset_for_protonet, batch_size=self.batch_size*3, shuffle=False)
 
         if len(self._multiple_gpus) > 1:
             print('Multiple GPUs')
             self._network = nn.DataParallel(self._network, self._multiple_gpus)
 
-        self._train(self.train_loader, self.test_loader)
+        prototypes, class_counts = self._train(self.train_loader, self.test_loader)
 
-        self.replace_fc()
+        self.replace_fc(prototypes, class_counts)
         if len(self._multiple_gpus) > 1:
             self._network = self._network.module
 
@@ -370,9 +424,10 @@ class Learner(BaseLearner):
         self._init_train(train_loader, test_loader, optimizer, scheduler)
         self._network.backbone.adapter_update()
 
-        self._compute_mean(self._network.backbone)
+        prototypes, class_counts = self._compute_mean(self._network.backbone)
         if self._cur_task > 0:
             self.classifer_align(self._network.backbone)
+        return prototypes, class_counts
 
     def get_optimizer(self, model):
         base_params = [p for name, p in model.named_parameters() if 'adapter' in name and p.requires_grad]
@@ -549,15 +604,11 @@ class Learner(BaseLearner):
             self._network.backbone.train()
             self.task_selector.train()  # Ensure task selector is in train mode
     
-            losses = 0.0
-            correct, total = 0, 0
-    
-            # Initialize class-specific loss tracker
-            class_losses = torch.zeros(self._total_classes, device=self._device)
-            class_counts = torch.zeros(self._total_classes, device=self._device)
+            # Loss, accuracy and class-specific loss tracker
+            stats = EpochStats(self._total_classes, self._device)
     
-            for i, (_, inputs, targets) in enumerate(train_loader):
-                inputs, targets = inputs.to(self._device), targets.to(self._device)
+            for i, (idx, inputs, targets) in enumerate(train_loader):
+                inputs, targets = inputs.to(self._device), targets.to(self._device).long()
     
                 # 🔹 Step 1: Forward Pass for Main Model (Use correct adapter)
                 output = self._network(inputs, adapter_id=self._cur_task, train=True)
@@ -578,23 +629,18 @@ class Learner(BaseLearner):
                 if self.args["adapter_momentum"] > 0:
                     self._network.backbone.adapter_merge()
     
-                losses += loss.sum().item()  # Sum loss over batch
-    
-                # Track class-specific losses
-                for class_id in range(self._total_classes):
-                    class_mask = (targets == class_id)  # Mask for current class
-                    class_counts[class_id] += class_mask.sum()
-                    class_losses[class_id] += ce_loss[class_mask].sum()  # Add losses for the class
+                # Track loss, accuracy and class-specific losses without syncing
+                stats.update(loss, ce_loss, logits, targets)
     
                 # 🔹 Step 4: Train Task Selector (Using Task-Specific Memory)
                 with torch.no_grad():
-                    shared_features = self._network.backbone(inputs)["features"].to(self._device)  # ✅ Move to correct device
+                    shared_features = self._trunk_features(train_loader.dataset, idx, inputs)
                 
                 task_probs, memory_loss = self.task_selector(shared_features, task_id=self._cur_task)  
 
                 
                 # Compute task selector loss (task prediction + memory stability)
-                task_labels = torch.tensor([self.cls2task[t.item()] for t in targets], device=self._device)
+                task_labels = self.cls2task_table[targets]
                 task_loss = F.cross_entropy(task_probs, task_labels) + factor * memory_loss  # Balance classification & memory loss
                 # print(f'task loss: {task_loss}')
                 # Optimize task selector
@@ -602,27 +648,19 @@ class Learner(BaseLearner):
                 task_loss.backward()
                 self.task_optimizer.step()
     
-                # 🔹 Compute training accuracy
-                _, preds = torch.max(logits, dim=1)
-                correct += preds.eq(targets).cpu().sum()
-                total += len(targets)
-    
-            # Normalize class losses (avoid division by zero)
-            class_losses /= (class_counts + 1e-8)
-    
             if scheduler:
                 scheduler.step()
-            train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
+            epoch_loss, train_acc = stats.summary()
     
             # Pass normalized class losses to the network
-            self._network.backbone.class_losses = class_losses
+            self._network.backbone.class_losses = stats.class_losses
     
             # Logging progress
             info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
                 self._cur_task,
                 epoch + 1,
                 self.args['tuned_epoch'],
-                losses / len(train_loader),
+                epoch_loss,
                 train_acc,
             )
             prog_bar.set_description(info)
@@ -725,53 +763,110 @@ class Learner(BaseLearner):
     @torch.no_grad()
     def _compute_mean(self, model):
         model.eval()
-        for class_idx in range(self._known_classes, self._total_classes):
-            data, targets, idx_dataset = self.data_manager.get_dataset(
-                np.arange(class_idx, class_idx + 1),
-                source="train",
-                mode="test",
-                ret_data=True,
-            )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=self.batch_size*3, shuffle=False, num_workers=4
+        method = self.args["ca_storage_efficient_method"]
+        num_classes = self._total_classes - self._known_classes
+        # one pass over the task's train split (test transform), feeding both the class statistics of the task's
+        # adapter and the adapter-0 prototypes, with one multi-route forward per batch;
+        # returns the prototypes [C_task, D] and per-class sample counts, for replace_fc in incremental_train
+        routes = [(self._cur_task, None)] if self._cur_task == 0 else [(self._cur_task, None), (0, None)]
+        if method != 'multi-centroid':
+            moments = RunningClassMoments(num_classes, model.out_dim, self._device, full_cov=method in ['covariance', 'low-rank'])
+        proto_sum = torch.zeros(num_classes, model.out_dim, device=self._device)
+        proto_count = torch.zeros(num_classes, device=self._device)
+        task_vectors, task_groups = [], []
+        for _, _inputs, _targets in self.train_loader_for_protonet:
+            route_features = model.forward_routes(_inputs.to(self._device), routes)
+            _vectors, _orig_vectors = route_features[0], route_features[-1]
+            _groups = _targets.to(self._device).long() - self._known_classes
+            proto_sum.index_add_(0, _groups, _orig_vectors.float())
+            proto_count.index_add_(0, _groups, torch.ones_like(proto_count[_groups]))
+            if method == 'multi-centroid':
+                # k-means needs all features of the task, clustered below
+                task_vectors.append(_vectors.float())
+                task_groups.append(_groups)
+            else:
+                moments.update(_vectors, _groups)
+
+        pooled_cov = None
+        if method == 'multi-centroid':
+            cluster_means, cluster_vars = batched_kmeans(
+                torch.cat(task_vectors, dim=0),
+                torch.cat(task_groups, dim=0),
+                num_classes,
+                self.args["n_centroids"],
+                n_iter=self.args.get("kmeans_iters", 100),
+                batch_size=self.args.get("kmeans_batch_size", 1024),
             )
-            
-            vectors = []
-            for _, _inputs, _targets in idx_loader:
-                _vectors = model(_inputs.to(self._device), adapter_id=self._cur_task, train=True)["features"]
-                vectors.append(_vectors)
-            vectors = torch.cat(vectors, dim=0)
-
-            if self.args["ca_storage_efficient_method"] == 'covariance':
-                features_per_cls = vectors
-                # print(features_per_cls.shape)
-                self.cls_mean[class_idx] = features_per_cls.mean(dim=0).to(self._device)
-                self.cls_cov[class_idx] = torch.cov(features_per_cls.T) + (torch.eye(self.cls_mean[class_idx].shape[-1]) * 1e-4).to(self._device)
-            elif self.args["ca_storage_efficient_method"] == 'variance':
-                features_per_cls = vectors
-                # print(features_per_cls.shape)
-                self.cls_mean[class_idx] = features_per_cls.mean(dim=0).to(self._device)
-                self.cls_cov[class_idx] = torch.diag(torch.cov(features_per_cls.T) + (torch.eye(self.cls_mean[class_idx].shape[-1]) * 1e-4).to(self._device))
-            elif self.args["ca_storage_efficient_method"] == 'multi-centroid':
-                from sklearn.cluster import KMeans
-                n_clusters = self.args["n_centroids"] # 10
-                features_per_cls = vectors.cpu().numpy()
-                kmeans = KMeans(n_clusters=n_clusters, n_init='auto')
-                kmeans.fit(features_per_cls)
-                cluster_lables = kmeans.labels_
-                cluster_means = []
-                cluster_vars = []
-                for i in range(n_clusters):
-                    cluster_data = features_per_cls[cluster_lables == i]
-                    cluster_mean = torch.tensor(np.mean(cluster_data, axis=0), dtype=torch.float64).to(self._device)
-                    cluster_var = torch.tensor(np.var(cluster_data, axis=0), dtype=torch.float64).to(self._device)
-                    cluster_means.append(cluster_mean)
-                    cluster_vars.append(cluster_var)
-                
-                self.cls_mean[class_idx] = cluster_means
-                self.cls_cov[class_idx] = cluster_vars
+            for class_idx in range(self._known_classes, self._total_classes):
+                self.cls_mean[class_idx] = list(cluster_means[class_idx - self._known_classes].to(self._device).unbind(0))
+                self.cls_cov[class_idx] = list(cluster_vars[class_idx - self._known_classes].to(self._device).unbind(0))
+        else:
+            class_means, class_covs = moments.mean.float(), moments.covariance()
+            for class_idx in range(self._known_classes, self._total_classes):
+                i = class_idx - self._known_classes
+                self.cls_mean[class_idx] = class_means[i]
+                if method == 'covariance':
+                    self.cls_cov[class_idx] = (class_covs[i].float() + torch.eye(class_means.shape[-1], device=self._device) * 1e-4).to(self._stats_device)
+                elif method == 'variance':
+                    self.cls_cov[class_idx] = class_covs[i].float() + 1e-4
+                elif method == 'low-rank':
+                    if self.ca_pooled_cov:
+                        pooled_cov = class_covs[i] if pooled_cov is None else pooled_cov + class_covs[i]
+                    else:
+                        self.cls_cov[class_idx] = self._low_rank_cov(class_covs[i])
+                else:
+                    raise NotImplementedError
+
+        if pooled_cov is not None:
+            # the classes of a task share one within-class covariance
+            self.task_cov[self._cur_task] = self._low_rank_cov(pooled_cov / (self._total_classes - self._known_classes))
+            for class_idx in range(self._known_classes, self._total_classes):
+                self.cls_cov[class_idx] = self.task_cov[self._cur_task]
+
+        self._refresh_prototypes()
+        return proto_sum / proto_count.clamp(min=1).unsqueeze(1), proto_count
+
+    def _low_rank_cov(self, cov):
+        """
+        Compresses a covariance into its top-k eigenbasis and a diagonal residual, cov ~= W W^T + diag(r).
+
+        Returns:
+            torch.Tensor: Factor W, eigenvectors scaled by the sqrt of their eigenvalues [D, k]
+            torch.Tensor: Residual variance r, including the 1e-4 ridge of the dense storage [D]
+        """
+        rank = min(self.ca_rank, cov.shape[0])
+        eigvals, eigvecs = torch.linalg.eigh(cov.double())
+        factor = eigvecs[:, -rank:] * eigvals[-rank:].clamp(min=0).sqrt()
+        residual = (torch.diagonal(cov).double() - factor.pow(2).sum(dim=1)).clamp(min=0) + 1e-4
+        return factor.float().to(self._stats_device), residual.float().to(self._stats_device)
+
+    @torch.no_grad()
+    def _refresh_prototypes(self, chunk_size=4096):
+        """
+        Stacks the stored class means into one matrix, together with the parts of the orthogonality loss that
+        only depend on them: the logsumexp of each prototype row over all prototypes, and its self-similarity.
+        """
+        protos = []
+        for v in self.cls_mean.values():
+            if isinstance(v, list):
+                protos.extend(v)
+            else:
+                protos.append(v)
+        proto_matrix = torch.stack(protos, dim=0).float().to(self._device).contiguous()
+        proto_lse = []
+        for chunk in proto_matrix.split(chunk_size):
+            proto_lse.append(torch.logsumexp(torch.matmul(chunk, proto_matrix.t()) / orth_temperature, dim=1))
+        self.proto_matrix = proto_matrix
+        self.proto_lse = torch.cat(proto_lse)
+        self.proto_self_sim = proto_matrix.pow(2).sum(dim=1) / orth_temperature
 
     def classifer_align(self, model):
+        self._update_ca_factors()
+        if self.ca_solver != 'sgd':
+            self._solve_classifier(model)
+            self._spill_ca_factors()
+            return
+
         model.train()
         
         run_epochs = self.crct_epochs
@@ -780,57 +875,20 @@ class Learner(BaseLearner):
         optimizer = optim.SGD(network_params, lr=self.ca_lr, momentum=0.9, weight_decay=5e-4)
         scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer=optimizer, T_max=run_epochs)
 
+        sampler = GaussianFeatureSampler(
+            self.ca_means, self.ca_labels, self.ca_scales, self.ca_diag, self.ca_scale_index,
+            chunk_size=self.class_stats_chunk, buffer_batches=self.args.get("ca_buffer_batches", 32),
+        )
+        num_sampled_pcls = self.batch_size * 5
+        logging.info("Sampling {} features per epoch from {} components".format(self._total_classes * num_sampled_pcls, self.ca_means.shape[0]))
+
         prog_bar = tqdm(range(run_epochs))
         for epoch in prog_bar:
 
-            sampled_data = []
-            sampled_label = []
-            num_sampled_pcls = self.batch_size * 5
-
-            if self.args["ca_storage_efficient_method"] in ['covariance', 'variance']:
-                for class_idx in range(self._total_classes):
-                    mean = self.cls_mean[class_idx].to(self._device)
-                    cov = self.cls_cov[class_idx].to(self._device)
-                    if self.args["ca_storage_efficient_method"] == 'variance':
-                        cov = torch.diag(cov)
-                    m = MultivariateNormal(mean.float(), cov.float())
-                    sampled_data_single = m.sample(sample_shape=(num_sampled_pcls,))
-                    sampled_data.append(sampled_data_single)
-
-                    sampled_label.extend([class_idx] * num_sampled_pcls)
-
-            elif self.args["ca_storage_efficient_method"] == 'multi-centroid':
-                for class_idx in range(self._total_classes):
-                    for cluster in range(len(self.cls_mean[class_idx])):
-                        mean = self.cls_mean[class_idx][cluster]
-                        var = self.cls_cov[class_idx][cluster]
-                        if var.mean() == 0:
-                            continue
-                        m = MultivariateNormal(mean.float(), (torch.diag(var) + 1e-4 * torch.eye(mean.shape[0]).to(mean.device)).float())
-                        sampled_data_single = m.sample(sample_shape=(num_sampled_pcls,))
-                        sampled_data.append(sampled_data_single)
-                        sampled_label.extend([class_idx] * num_sampled_pcls)
-            else:
-                raise NotImplementedError
-
-
-            sampled_data = torch.cat(sampled_data, dim=0).float().to(self._device)
-            sampled_label = torch.tensor(sampled_label).long().to(self._device)
-            if epoch == 0:
-                print("sampled data shape: ", sampled_data.shape)
-
-            inputs = sampled_data
-            targets = sampled_label
-
-            sf_indexes = torch.randperm(inputs.size(0))
-            inputs = inputs[sf_indexes]
-            targets = targets[sf_indexes]
-
             losses = 0.0
             correct, total = 0, 0
-            for _iter in range(self._total_classes):
-                inp = inputs[_iter * num_sampled_pcls:(_iter + 1) * num_sampled_pcls]
-                tgt = targets[_iter * num_sampled_pcls:(_iter + 1) * num_sampled_pcls]
+            # shuffled mini-batches of num_sampled_pcls features, drawn in the background while the classifier trains
+            for inp, tgt in sampler.epoch(num_sampled_pcls, num_sampled_pcls, num_batches=self._total_classes):
                 outputs = model(inp, fc_only=True)
                 logits = outputs['logits'][:, :self._total_classes]
 
@@ -838,13 +896,13 @@ class Learner(BaseLearner):
                 
                 _, preds = torch.max(logits, dim=1)
                 
-                correct += preds.eq(tgt.expand_as(preds)).cpu().sum()
+                correct += preds.eq(tgt.expand_as(preds)).sum()
                 total += len(tgt)
 
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
-                losses += loss
+                losses += loss.detach()
 
             scheduler.step()
             ca_acc = np.round(tensor2numpy(correct) * 100 / total, decimals=2)
@@ -858,25 +916,178 @@ class Learner(BaseLearner):
             prog_bar.set_description(info)
          
         logging.info(info)
+        self._spill_ca_factors()
+
+    def _spill_ca_factors(self):
+        # the aligned classes are old from now on, so their factors can leave the device
+        self.ca_scales.spill()
+        if self.ca_diag is not None:
+            self.ca_diag.spill()
+
+    @torch.no_grad()
+    def _update_ca_factors(self):
+        """
+        Factorizes the class statistics of the classes added since the last call and appends them to the stacked store.
+        Full covariances keep their Cholesky factor [D, D] and are removed from cls_cov;
+        diagonal ones (variance, multi-centroid) their std [D].
+        Means and labels stay on the device; factors go to ClassStatsStores, spilled by classifer_align once aligned.
+        """
+        method = self.args["ca_storage_efficient_method"]
+        means, scales, labels, diags = [], [], [], []
+        if method == 'covariance' and self._total_classes > self.ca_factorized_classes:
+            # factorized class_stats_chunk classes at a time straight into new rows of the store, so only one chunk
+            # of dense float64 covariances is on the device; the factor is all the sampler needs, so each dense
+            # covariance is dropped as soon as it is factorized
+            dim = self.cls_mean[self.ca_factorized_classes].shape[-1]
+            if self.ca_scales is None:
+                self.ca_scales = self._class_stats_store("ca_scales", (dim, dim))
+            new_classes = list(range(self.ca_factorized_classes, self._total_classes))
+            scales = self.ca_scales.allocate(len(new_classes))
+            for start in range(0, len(new_classes), self.class_stats_chunk):
+                chunk = new_classes[start:start + self.class_stats_chunk]
+                covs = torch.stack([self.cls_cov.pop(class_idx).to(self._device).double() for class_idx in chunk], dim=0)
+                scales[start:start + len(chunk)] = torch.linalg.cholesky(covs)
+                del covs
+        for class_idx in range(self.ca_factorized_classes, self._total_classes):
+            if method == 'covariance':
+                means.append(self.cls_mean[class_idx])
+                labels.append(class_idx)
+            elif method == 'variance':
+                means.append(self.cls_mean[class_idx])
+                scales.append(self.cls_cov[class_idx].to(self._device).double().sqrt())
+                labels.append(class_idx)
+            elif method == 'multi-centroid':
+                for mean, var in zip(self.cls_mean[class_idx], self.cls_cov[class_idx]):
+                    if var.mean() == 0:
+                        continue
+                    means.append(mean)
+                    scales.append((var.to(self._device).double() + 1e-4).sqrt())
+                    labels.append(class_idx)
+            elif method == 'low-rank':
+                means.append(self.cls_mean[class_idx])
+                labels.append(class_idx)
+                if not self.ca_pooled_cov:
+                    factor, residual = self.cls_cov[class_idx]
+                    scales.append(factor)
+                    diags.append(residual.sqrt())
+            else:
+                raise NotImplementedError
+        if method == 'low-rank' and self.ca_pooled_cov:
+            # one factor per task, in task order, so a component's factor index is its task id
+            for task in sorted(set(self.cls2task[class_idx] for class_idx in labels)):
+                factor, residual = self.task_cov[task]
+                scales.append(factor)
+                diags.append(residual.sqrt())
+        self.ca_factorized_classes = self._total_classes
+        if len(means) == 0:
+            return
+
+        means = torch.stack(means, dim=0).float().to(self._device)
+        scales = torch.stack(scales, dim=0) if isinstance(scales, list) else scales
+        diags = torch.stack(diags, dim=0) if len(diags) > 0 else None
+        scale_index = torch.tensor([self.cls2task[class_idx] for class_idx in labels], dtype=torch.long, device=self._device) if self.ca_pooled_cov and method == 'low-rank' else None
+        labels = torch.tensor(labels, dtype=torch.long, device=self._device)
+        if self.ca_solver != 'sgd':
+            self._update_ca_moments(means, labels, scales, diags, None if scale_index is None else scale_index - scale_index.min())
+        if self.ca_means is not None:
+            means = torch.cat([self.ca_means, means], dim=0)
+            labels = torch.cat([self.ca_labels, labels], dim=0)
+            scale_index = torch.cat([self.ca_scale_index, scale_index], dim=0) if scale_index is not None else None
+        else:
+            if self.ca_scales is None:
+                self.ca_scales = self._class_stats_store("ca_scales", scales.shape[1:])
+            self.ca_diag = self._class_stats_store("ca_diag", diags.shape[1:]) if diags is not None else None
+        if method != 'covariance':
+            # the covariance factors were written into the store directly
+            self.ca_scales.append(scales)
+        if diags is not None:
+            self.ca_diag.append(diags)
+        self.ca_means, self.ca_labels, self.ca_scale_index = means, labels, scale_index
+
+    @torch.no_grad()
+    def _update_ca_moments(self, means, labels, scales, diags=None, scale_index=None):
+        """
+        Adds new Gaussian components to the running moments of the closed-form solvers, all components weighted
+        equally as in the sampled alignment: the sum of E[x x^T] over components, and per class the sum of the
+        component means and the number of components.
+        """
+        if scale_index is not None:
+            scales = scales[scale_index.to(scales.device)]
+            diags = diags[scale_index.to(diags.device)] if diags is not None else None
+        second_moment = torch.matmul(means.double().t(), means.double())
+        for start in range(0, means.shape[0], self.class_stats_chunk):
+            chunk = scales[start:start + self.class_stats_chunk].to(self._device).double()
+            if chunk.dim() == 3:
+                second_moment += torch.einsum('ndk,nek->de', chunk, chunk)
+            else:
+                second_moment += torch.diag(chunk.pow(2).sum(dim=0))
+            if diags is not None:
+                second_moment += torch.diag(diags[start:start + self.class_stats_chunk].to(self._device).double().pow(2).sum(dim=0))
+
+        class_sum = torch.zeros(self._total_classes, means.shape[1], dtype=torch.float64, device=self._device)
+        class_count = torch.zeros(self._total_classes, dtype=torch.float64, device=self._device)
+        if self.ca_second_moment is not None:
+            second_moment += self.ca_second_moment
+            class_sum[:self.ca_class_sum.shape[0]] = self.ca_class_sum
+            class_count[:self.ca_class_count.shape[0]] = self.ca_class_count
+        class_sum.index_add_(0, labels, means.double())
+        class_count.index_add_(0, labels, torch.ones_like(labels, dtype=torch.float64))
+        self.ca_second_moment, self.ca_class_sum, self.ca_class_count = second_moment, class_sum, class_count
+
+    @torch.no_grad()
+    def _solve_classifier(self, model):
+        """
+        Fits the head in closed form from the running moments, as the expectation of the sampled alignment:
+        - ridge: least squares onto one-hot targets, (E[x x^T] + reg I) W = E[x y^T], with an unregularized bias
+        - lda: shared within-class covariance S, W_c = (S + reg I)^-1 m_c, b_c = -m_c^T W_c / 2 + log p_c
+        reg is ca_solver_reg times the mean variance of the features.
+        """
+        num_classes, dim = self.ca_class_sum.shape
+        num_components = self.ca_class_count.sum()
+        eye = torch.eye(dim, dtype=torch.float64, device=self._device)
+        if self.ca_solver == 'ridge':
+            gram = torch.zeros(dim + 1, dim + 1, dtype=torch.float64, device=self._device)
+            gram[:dim, :dim] = self.ca_second_moment
+            gram[:dim, dim] = gram[dim, :dim] = self.ca_class_sum.sum(dim=0)
+            gram[dim, dim] = num_components
+            gram /= num_components
+            # E[x^2] - E[x]^2 per dimension: the variance of the features, not their raw second moment
+            feature_var = torch.diagonal(gram[:dim, :dim]) - gram[:dim, dim].pow(2)
+            gram[:dim, :dim] += self.ca_solver_reg * feature_var.mean() * eye
+            target = torch.cat([self.ca_class_sum, self.ca_class_count.unsqueeze(1)], dim=1).t() / num_components
+            solution = torch.linalg.solve(gram, target)
+            weight, bias = solution[:dim].t(), solution[dim]
+        elif self.ca_solver == 'lda':
+            class_count = self.ca_class_count.clamp(min=1)
+            class_mean = self.ca_class_sum / class_count.unsqueeze(1)
+            within = (self.ca_second_moment - torch.matmul(class_mean.t() * class_count, class_mean)) / num_components
+            within += self.ca_solver_reg * torch.diagonal(within).mean() * eye
+            weight = torch.linalg.solve(within, class_mean.t()).t()
+            bias = -0.5 * (weight * class_mean).sum(dim=1) + torch.log(class_count / num_components)
+        else:
+            raise NotImplementedError
+        model.head.weight.data[:num_classes] = weight.to(model.head.weight.dtype)
+        model.head.bias.data[:num_classes] = bias.to(model.head.bias.dtype)
+        logging.info("Task {}, classifier aligned in closed form ({})".format(self._cur_task, self.ca_solver))
+
+    def _class_stats_store(self, name, row_shape):
+        return ClassStatsStore(name, row_shape, self._device, tier=self.class_stats_tier, root=self.args.get("class_stats_dir"))
 
     def orth_loss(self, features, targets):
-        if self.cls_mean:
-            # orth loss of this batch
-            sample_mean = []
-            for k, v in self.cls_mean.items():
-                if isinstance(v, list):
-                    sample_mean.extend(v)
-                else:
-                    sample_mean.append(v)
-            sample_mean = torch.stack(sample_mean, dim=0).to(self._device, non_blocking=True)
-            M = torch.cat([sample_mean, features], dim=0)
-            sim = torch.matmul(M, M.t()) / 0.8
-            loss = torch.nn.functional.cross_entropy(sim, torch.arange(0, sim.shape[0]).long().to(self._device))
+        if self.proto_matrix is not None:
+            # orth loss of this batch: cross-entropy over the rows of the similarity of [prototypes; features],
+            # built from the B x (C + B) block only, as the C x C prototype block is cached by _refresh_prototypes
+            proto_matrix = self.proto_matrix.to(features.dtype)
+            cross_sim = torch.matmul(features, proto_matrix.t()) / orth_temperature
+            self_sim = torch.matmul(features, features.t()) / orth_temperature
+            feature_rows = torch.logsumexp(torch.cat([cross_sim, self_sim], dim=1), dim=1) - self_sim.diagonal()
+            proto_rows = torch.logaddexp(self.proto_lse, torch.logsumexp(cross_sim.t(), dim=1)) - self.proto_self_sim
+            loss = (feature_rows.sum() + proto_rows.sum()) / (proto_matrix.shape[0] + features.shape[0])
             # print(loss)
             return self.args["reg"] * loss
             # return 0.1 * loss
         else:
-            sim = torch.matmul(features, features.t()) / 0.8
+            sim = torch.matmul(features, features.t()) / orth_temperature
             loss = torch.nn.functional.cross_entropy(sim, torch.arange(0, sim.shape[0]).long().to(self._device))
             return self.args["reg"] * loss
             # return 0.0
@@ -1192,6 +1403,104 @@ class Learner(BaseLearner):
     #     return np.concatenate(y_pred), np.concatenate(y_true)  # [N, topk]
     
     
+    @torch.no_grad()
+    def _routed_logits(self, inputs, adapter_indices, dataset=None, idx=None):
+        """
+        Route each sample to its selected adapter(s) and return the logits in the original batch order.
+
+        Args:
+            inputs (torch.Tensor): Input images [B, C, H, W]
+            adapter_indices (torch.Tensor): Top-k adapter ids from the task selector [B, k]
+            dataset, idx (optional): Source dataset and loader indices of the batch, to reuse cached features
+
+        Returns:
+            torch.Tensor: Logits [B, total_classes]. In ensemble mode, the mean over the valid top-k adapters.
+        """
+        backbone = self._network.backbone
+        valid = (adapter_indices >= 0) & (adapter_indices <= self._cur_task)
+
+        if self.ensemble:
+            routes = adapter_indices
+        else:
+            # single pass Top 1 adapter, out-of-range selections fall back to adapter 0
+            routes = torch.where(valid[:, 0], adapter_indices[:, 0], torch.zeros_like(adapter_indices[:, 0])).unsqueeze(1)
+            valid = torch.ones_like(routes, dtype=torch.bool)
+
+        # 🔹 Group the batch by selected adapter, run all groups in one fused forward and scatter back into batch order
+        groups = []
+        for adapter_id in torch.unique(routes[valid]).tolist():
+            groups.append((adapter_id, ((routes == adapter_id) & valid).any(dim=1).nonzero().squeeze(-1)))
+        group_features = self._route_features(inputs, groups, dataset, idx)
+
+        logits_sum = torch.zeros(inputs.shape[0], self._total_classes, device=self._device)
+        counts = torch.zeros(inputs.shape[0], 1, device=self._device)
+        for (adapter_id, sample_idx), features in zip(groups, group_features):
+            logits = backbone(features, fc_only=True)["logits"][:, :self._total_classes]
+            logits_sum.index_add_(0, sample_idx, logits)
+            counts[sample_idx] += 1
+
+        # 🔹 Average logits across valid adapters (instead of weighted sum)
+        return logits_sum / counts.clamp(min=1)
+
+    def _feature_store(self, adapter_id):
+        # the pretrained trunk and the stored adapters are frozen, so their features can be cached
+        if adapter_id == -1:
+            return self.trunk_features, None
+        elif adapter_id < len(self._network.backbone.adapter_bank):
+            return self.adapter_features, adapter_id
+        return None, None
+
+    @torch.no_grad()
+    def _route_features(self, inputs, routes, dataset=None, idx=None):
+        """
+        Features of several routes over one batch, served from the feature caches where possible and
+        otherwise computed together in one fused multi-route backbone forward.
+
+        Args:
+            inputs (torch.Tensor): Input images [B, C, H, W]
+            routes (list): (adapter_id, sample_idx) pairs. adapter_id -1 is the pretrained trunk,
+                sample_idx None selects the whole batch.
+            dataset, idx (optional): Source dataset and loader indices of the batch, to use the caches
+
+        Returns:
+            list: Features [len(sample_idx), feature_dim] for each route.
+        """
+        feature_dim = self._network.feature_dim
+        results, pending = [], []
+        for r, (adapter_id, sample_idx) in enumerate(routes):
+            whole_batch = sample_idx is None
+            if whole_batch:
+                sample_idx = torch.arange(inputs.shape[0], device=inputs.device)
+            features = torch.empty(len(sample_idx), feature_dim, device=inputs.device)
+            misses = torch.ones(len(sample_idx), dtype=torch.bool, device=inputs.device)
+
+            store, route = self._feature_store(adapter_id)
+            if store is not None and dataset is not None:
+                hits, cached = store.lookup(dataset, idx[sample_idx.cpu()], feature_dim, route)
+                if hits is not None and hits.any():
+                    hits = torch.from_numpy(hits).to(inputs.device)
+                    features[hits] = torch.from_numpy(cached).to(inputs.device)
+                    misses = ~hits
+
+            results.append(features)
+            if misses.all():
+                pending.append((r, adapter_id, sample_idx, None if whole_batch else sample_idx, misses))
+            elif misses.any():
+                pending.append((r, adapter_id, sample_idx[misses], sample_idx[misses], misses))
+
+        if pending:
+            computed = self._network.backbone.forward_routes(inputs, [(adapter_id, route_idx) for _, adapter_id, _, route_idx, _ in pending])
+            for (r, adapter_id, sample_idx, _, misses), features in zip(pending, computed):
+                results[r][misses] = features
+                store, route = self._feature_store(adapter_id)
+                if store is not None and dataset is not None:
+                    store.update(dataset, idx[sample_idx.cpu()], features, route)
+
+        return results
+
+    def _trunk_features(self, dataset, idx, inputs):
+        return self._route_features(inputs, [(-1, None)], dataset, idx)[0]
+
     def _eval_cnn(self, loader):
         start_time = time.time()
         self._network.eval()
@@ -1200,63 +1509,27 @@ class Learner(BaseLearner):
         y_pred, y_true = [], []
         orig_y_pred = []
     
-        for _, (_, inputs, targets) in enumerate(loader):
+        for _, (idx, inputs, targets) in enumerate(loader):
             inputs = inputs.to(self._device)
             with torch.no_grad():
-                # 🔹 Step 1: Get Predictions from Adapter 0 (Baseline)
-                orig_logits = self._network.forward_orig(inputs)["logits"][:, :self._total_classes]
-                orig_probs = F.softmax(orig_logits, dim=1)  # Convert to probabilities
-                orig_preds = torch.max(orig_logits, dim=1)[1].cpu().numpy()
-                orig_y_pred.append(orig_preds)
-    
-                # 🔹 Step 2: Extract Shared Features
-                shared_features = self._network.backbone(inputs)["features"]
+                # 🔹 Step 1: Shared trunk features (and Adapter 0 features for the diagnostics probe) from one fused forward
+                routes = [(-1, None), (0, None)] if self.diagnostics else [(-1, None)]
+                route_features = self._route_features(inputs, routes, loader.dataset, idx)
+                shared_features = route_features[0]
+
+                # 🔹 Step 2: Get Predictions from Adapter 0 (Baseline), diagnostics only
+                if self.diagnostics:
+                    orig_logits = self._network.fc(route_features[1])["logits"][:, :self._total_classes]
+                    orig_preds = torch.max(orig_logits, dim=1)[1].cpu().numpy()
+                    orig_y_pred.append(orig_preds)
     
                 # 🔹 Step 3: Use Task Selector to Get Top-3 Adapters
                 task_probs = self.task_selector(shared_features)  # Shape: [B, num_tasks]
                 topk_adapters = torch.topk(task_probs, k=3, dim=1)  # Get top-3 adapters
                 adapter_indices = topk_adapters.indices  # Shape: [batch_size, 3]
     
-                # 🔹 Step 4: Extract Features Using the Selected Adapter(s)
-                logits_list = []
-                for i in range(inputs.shape[0]):  # Iterate over the batch
-                    if self.ensemble:
-                        sample_logits = []
-                        for j in range(3):  # Top-3 adapters ensemble for abalation
-                            if int(adapter_indices[i, j].item()) < 0 or int(adapter_indices[i, j].item()) > self._cur_task:
-                                continue
-                            adapter_id = int(adapter_indices[i, j].item())
-    
-                            selected_features = self._network.backbone(
-                                inputs[i].unsqueeze(0),  
-                                adapter_id=adapter_id,  
-                                train=False
-                            )["features"]
-    
-                            logits = self._network.backbone(selected_features, fc_only=True)["logits"][:, :self._total_classes]
-                            sample_logits.append(logits)
-    
-                        # 🔹 Average logits across valid adapters (instead of weighted sum)
-                        logits_stack = torch.stack(sample_logits, dim=0)  # Shape: [num_valid_adapters, 1, num_classes]
-                        averaged_logits = logits_stack.mean(dim=0)  # Simple mean across adapters
-                        logits_list.append(averaged_logits)
-                    else: #single pass Top 1 adapter
-                        if int(adapter_indices[i, 0].item()) < 0 or int(adapter_indices[i, 0].item()) > self._cur_task:
-                            adapter_id=0
-                        else:
-                            adapter_id = int(adapter_indices[i, 0].item())
-                            
-                        selected_features = self._network.backbone(
-                            inputs[i].unsqueeze(0),  
-                            adapter_id=adapter_id,  
-                            train=False
-                        )["features"]
-    
-                        logits = self._network.backbone(selected_features, fc_only=True)["logits"][:, :self._total_classes]
-                        logits_list.append(logits)
-    
-                # 🔹 Stack logits to reconstruct the batch
-                final_logits = torch.cat(logits_list, dim=0).to(self._device)
+                # 🔹 Step 4: Extract Features Using the Selected Adapter(s), one batched pass per adapter
+                final_logits = self._routed_logits(inputs, adapter_indices, loader.dataset, idx)
     
                 # 🔹 Step 5: Apply Softmax if Ensembling
                 if self.ensemble:
@@ -1268,18 +1541,16 @@ class Learner(BaseLearner):
             y_pred.append(predicts.cpu().numpy())
             y_true.append(targets.cpu().numpy())
     
-        # 🔹 Step 7: Compute Original Model Accuracy
-        orig_acc = (np.concatenate(orig_y_pred) == np.concatenate(y_true)).sum() * 100 / len(np.concatenate(y_true))
-    
-        # 🔹 Store execution time and calculate average
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        self.eval_cnn_times.append(elapsed_time)
-        avg_time = sum(self.eval_cnn_times) / len(self.eval_cnn_times)
-    
-        print(f"\n⏳ Time taken for _eval_cnn: {elapsed_time:.4f} seconds")
-        print(f"📊 Average time for _eval_cnn calls: {avg_time:.4f} seconds")
-        print("🎯 The accuracy of the original model: {}".format(np.around(orig_acc, 2)))
+        if self.trunk_features is not None:
+            self.trunk_features.flush()
+
+        # 🔹 Step 7: Record execution time and, in diagnostics mode, the Original Model Accuracy
+        self.eval_diagnostics["eval_time"].append(time.time() - start_time)
+        if self.diagnostics:
+            y_true_all = np.concatenate(y_true)
+            orig_acc = (np.concatenate(orig_y_pred) == y_true_all).sum() * 100 / len(y_true_all)
+            self.eval_diagnostics["orig_acc"].append(np.around(orig_acc, 2))
+            logging.info("Eval diagnostics: {}".format({k: v[-1] for k, v in self.eval_diagnostics.items()}))
     
         return np.concatenate(y_pred), np.concatenate(y_true)  # [N, topk]
 
@@ -0,0 +1,72 @@
+import torch
+from torchvision import transforms
+from torchvision.transforms import functional as TF
+
+from utils.batch_transforms import BatchAugment
+
+
+def _reference(img, box, size):
+    # what RandomResizedCrop does once get_params returned this box
+    x1, y1, x2, y2 = [int(v) for v in box]
+    return TF.resized_crop(img.float(), y1, x1, y2 - y1, x2 - x1, list(size), antialias=True)
+
+
+def test_resized_crops_match_random_resized_crop_at_image_edges():
+    torch.manual_seed(0)
+    augment = BatchAugment(32)
+    # the small image sits in a larger padded batch; its crop touches its right and bottom edges
+    small = torch.randint(0, 256, (3, 20, 24), dtype=torch.uint8)
+    large = torch.randint(0, 256, (3, 40, 48), dtype=torch.uint8)
+    boxes = torch.tensor([[8, 4, 24, 20], [0, 0, 48, 40]])
+
+    out = augment.resized_crops([small, large], boxes)
+
+    assert out.shape == (2, 3, 32, 32)
+    torch.testing.assert_close(out[0], _reference(small, boxes[0], augment.size), atol=1e-3, rtol=0)
+    # no dark last row or column from the padding
+    assert (out[0, :, -1, :] - _reference(small, boxes[0], augment.size)[:, -1, :]).abs().max() < 1e-3
+    assert (out[0, :, :, -1] - _reference(small, boxes[0], augment.size)[:, :, -1]).abs().max() < 1e-3
+
+
+def test_resized_crops_on_constant_images_stay_constant():
+    augment = BatchAugment(16)
+    small = torch.full((3, 10, 12), 200, dtype=torch.uint8)
+    large = torch.full((3, 30, 30), 50, dtype=torch.uint8)
+    boxes = torch.tensor([[0, 0, 12, 10], [3, 3, 30, 30]])
+
+    out = augment.resized_crops([small, large], boxes)
+
+    torch.testing.assert_close(out[0], torch.full_like(out[0], 200.0))
+    torch.testing.assert_close(out[1], torch.full_like(out[1], 50.0))
+
+
+def test_crop_boxes_lie_within_their_images():
+    torch.manual_seed(0)
+    augment = BatchAugment(224, scale=(0.05, 1.0))
+    heights = torch.randint(16, 300, (256,))
+    widths = torch.randint(16, 300, (256,))
+
+    boxes = augment.crop_boxes(heights, widths)
+
+    assert (boxes[:, 0] >= 0).all() and (boxes[:, 1] >= 0).all()
+    assert (boxes[:, 2] <= widths).all() and (boxes[:, 3] <= heights).all()
+    assert (boxes[:, 2] > boxes[:, 0]).all() and (boxes[:, 3] > boxes[:, 1]).all()
+
+
+def test_call_matches_per_sample_transform_shapes_and_range():
+    torch.manual_seed(0)
+    trsf = [transforms.RandomResizedCrop(32), transforms.RandomHorizontalFlip(), transforms.ToTensor()]
+    augment = BatchAugment.from_transforms(trsf)
+    batch = [(i, torch.randint(0, 256, (3, 20 + i, 30 - i), dtype=torch.uint8), i % 3) for i in range(4)]
+
+    idx, out, labels = augment(batch)
+
+    assert idx.tolist() == [0, 1, 2, 3]
+    assert labels.tolist() == [0, 1, 2, 0]
+    assert out.shape == (4, 3, 32, 32)
+    assert out.min() >= 0 and out.max() <= 1
+
+
+def test_from_transforms_rejects_unsupported_lists():
+    trsf = [transforms.RandomCrop(32, padding=4), transforms.RandomHorizontalFlip(), transforms.ToTensor()]
+    assert BatchAugment.from_transforms(trsf) is None
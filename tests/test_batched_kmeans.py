@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+from sklearn.cluster import KMeans
+
+from utils.toolkit import batched_kmeans
+
+
+def _blobs(num_groups, n_clusters, per_cluster, dim, seed=0):
+    rng = np.random.RandomState(seed)
+    features, groups = [], []
+    for g in range(num_groups):
+        centers = rng.uniform(-20, 20, size=(n_clusters, dim))
+        for center in centers:
+            features.append(center + rng.randn(per_cluster, dim))
+            groups.append(np.full(per_cluster, g))
+    return np.concatenate(features).astype(np.float32), np.concatenate(groups)
+
+
+
+def _reference(features, n_clusters):
+    km = KMeans(n_clusters=n_clusters, n_init=10, random_state=0).fit(features)
+    variances = np.stack([features[km.labels_ == k].var(axis=0) for k in range(n_clusters)])
+    order = np.lexsort(km.cluster_centers_.T[::-1])
+    return km.cluster_centers_[order], variances[order]
+
+
+def _matched(means, variances, reference_means):
+    # pair every cluster with its nearest reference center
+    order = np.argmin(((reference_means[:, None] - means[None]) ** 2).sum(-1), axis=1)
+    return means[order], variances[order]
+
+
+def test_full_batch_matches_sklearn_per_group():
+    torch.manual_seed(0)
+    features, groups = _blobs(num_groups=4, n_clusters=3, per_cluster=60, dim=5)
+
+    means, variances = batched_kmeans(torch.from_numpy(features), torch.from_numpy(groups), 4, 3)
+
+    for g in range(4):
+        ref_means, ref_vars = _reference(features[groups == g], 3)
+        got_means, got_vars = _matched(means[g].numpy(), variances[g].numpy(), ref_means)
+        np.testing.assert_allclose(got_means, ref_means, atol=1e-3)
+        np.testing.assert_allclose(got_vars, ref_vars, atol=1e-3)
+        assert len({tuple(m) for m in got_means.round(3)}) == 3
+
+
+def test_mini_batch_groups_converge_to_the_sklearn_centers():
+    torch.manual_seed(0)
+    features, groups = _blobs(num_groups=2, n_clusters=4, per_cluster=500, dim=3, seed=1)
+
+    means, _ = batched_kmeans(
+        torch.from_numpy(features), torch.from_numpy(groups), 2, 4, n_iter=200, batch_size=256
+    )
+
+    for g in range(2):
+        ref_means, _ = _reference(features[groups == g], 4)
+        got_means, _ = _matched(means[g].numpy(), np.zeros_like(means[g].numpy()), ref_means)
+        # the final statistics come from a full assignment, so only the assignment has to agree
+        np.testing.assert_allclose(got_means, ref_means, atol=1e-3)
+
+
+def test_groups_of_different_sizes_are_independent():
+    torch.manual_seed(0)
+    features = torch.cat([torch.randn(10, 2) + 50, torch.randn(200, 2) - 50])
+    groups = torch.cat([torch.zeros(10, dtype=torch.long), torch.ones(200, dtype=torch.long)])
+
+    means, variances = batched_kmeans(features, groups, 2, 1)
+
+    torch.testing.assert_close(means[:, 0], torch.stack([features[:10].mean(0), features[10:].mean(0)]))
+    torch.testing.assert_close(
+        variances[:, 0], torch.stack([features[:10].var(0, unbiased=False), features[10:].var(0, unbiased=False)])
+    )
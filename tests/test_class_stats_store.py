@@ -0,0 +1,74 @@
+import gc
+import os
+
+import pytest
+import torch
+
+from utils.class_stats import ClassStatsStore
+
+
+def _fill(store, batches):
+    for rows in batches:
+        store.append(rows)
+        store.spill()
+    return torch.cat(batches, dim=0)
+
+
+@pytest.mark.parametrize("tier", ["device", "host", "disk"])
+def test_chunks_return_the_appended_rows_in_order(tier, tmp_path):
+    torch.manual_seed(0)
+    store = ClassStatsStore("scales", (4, 3), "cpu", tier=tier, root=str(tmp_path))
+    expected = _fill(store, [torch.randn(5, 4, 3), torch.randn(7, 4, 3), torch.randn(2, 4, 3)])
+    # rows appended after the last spill stay on the device tier
+    tail = torch.randn(3, 4, 3)
+    store.append(tail)
+    expected = torch.cat([expected, tail], dim=0)
+
+    assert len(store) == expected.shape[0]
+    starts, chunks = zip(*store.chunks(4))
+    assert all(chunk.shape[0] <= 4 for chunk in chunks)
+    assert list(starts) == [sum(c.shape[0] for c in chunks[:i]) for i in range(len(chunks))]
+    torch.testing.assert_close(torch.cat(chunks, dim=0), expected)
+    torch.testing.assert_close(store.load(), expected)
+
+
+def test_disk_tier_file_is_removed_with_the_store(tmp_path):
+    store = ClassStatsStore("scales", (2,), "cpu", tier="disk", root=str(tmp_path))
+    _fill(store, [torch.ones(3, 2)])
+    path = store.path
+    assert os.path.exists(path)
+
+    del store
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+def test_disk_tier_stores_do_not_share_a_file(tmp_path):
+    first = ClassStatsStore("scales", (2,), "cpu", tier="disk", root=str(tmp_path))
+    second = ClassStatsStore("scales", (2,), "cpu", tier="disk", root=str(tmp_path))
+    _fill(first, [torch.zeros(2, 2)])
+    _fill(second, [torch.ones(2, 2)])
+
+    assert first.path != second.path
+    torch.testing.assert_close(first.load(), torch.zeros(2, 2))
+
+
+def test_unknown_tier_and_disk_without_root_are_rejected():
+    with pytest.raises(ValueError):
+        ClassStatsStore("scales", (2,), "cpu", tier="ssd")
+    with pytest.raises(ValueError):
+        ClassStatsStore("scales", (2,), "cpu", tier="disk")
+
+
+def test_device_tier_grows_in_place_and_keeps_its_rows():
+    store = ClassStatsStore("scales", (3,), "cpu")
+    store.append(torch.zeros(2, 3))
+    # the capacity doubles to four rows
+    store.allocate(1).fill_(1)
+    buffer = store._hot
+    store.append(torch.full((1, 3), 2.0))
+
+    # the spare capacity of the last growth is used without reallocating
+    assert store._hot is buffer
+    assert len(store) == 4
+    torch.testing.assert_close(store.load()[:, 0], torch.tensor([0., 0., 1., 2.]))
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from torchvision import transforms
+
+from utils import data_manager
+from utils.data_manager import DataManager, _map_new_class_index
+
+
+class _ToyData(object):
+    use_path = False
+    train_trsf = [transforms.RandomHorizontalFlip()]
+    test_trsf = []
+    common_trsf = [transforms.ToTensor()]
+    class_order = [3, 1, 4, 0, 2, 5]
+
+    def __init__(self):
+        rng = np.random.RandomState(0)
+        self.train_targets = rng.randint(0, 6, size=120)
+        self.test_targets = rng.randint(0, 6, size=40)
+        self.train_data = rng.randint(0, 256, size=(120, 4, 4, 3), dtype=np.uint8)
+        self.test_data = rng.randint(0, 256, size=(40, 4, 4, 3), dtype=np.uint8)
+
+    def download_data(self):
+        pass
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(data_manager, "_get_idata", lambda dataset_name, args=None: _ToyData())
+    return DataManager("toy", False, 0, 2, 2, {})
+
+
+def _where_loop(x, y, indices):
+    # the per-class np.where selection get_dataset used before the class index
+    data, targets = [], []
+    for idx in indices:
+        idxes = np.where(np.logical_and(y >= idx, y < idx + 1))[0]
+        data.append(x[idxes])
+        targets.append(y[idxes])
+    return np.concatenate(data), np.concatenate(targets)
+
+
+def test_class_order_mapping_matches_list_index():
+    order = _ToyData.class_order
+    y = np.random.RandomState(1).randint(0, 6, size=50)
+
+    np.testing.assert_array_equal(_map_new_class_index(y, order), [order.index(v) for v in y])
+
+
+@pytest.mark.parametrize("source", ["train", "test"])
+@pytest.mark.parametrize("indices", [np.arange(0, 2), np.arange(2, 6), np.array([4, 1, 5]), np.array([], dtype=np.int64)])
+def test_get_dataset_order_matches_the_where_loop(manager, source, indices):
+    x = manager._train_data if source == "train" else manager._test_data
+    y = manager._train_targets if source == "train" else manager._test_targets
+    if len(indices) == 0:
+        expected_data, expected_targets = x[:0], y[:0]
+    else:
+        expected_data, expected_targets = _where_loop(x, y, indices)
+
+    data, targets, dataset = manager.get_dataset(indices, source=source, mode="test", ret_data=True)
+
+    np.testing.assert_array_equal(data, expected_data)
+    np.testing.assert_array_equal(targets, expected_targets)
+    assert len(dataset) == len(expected_targets)
+    assert [dataset[i][2] for i in range(len(dataset))] == expected_targets.tolist()
+    # sample ids are positions in the source split
+    np.testing.assert_array_equal(x[dataset.sample_ids], expected_data)
+
+
+def test_get_dataset_with_appendent_matches_the_where_loop(manager):
+    memory_data, memory_targets = manager._train_data[:10], manager._train_targets[:10]
+    expected_data, expected_targets = _where_loop(manager._train_data, manager._train_targets, np.arange(2, 4))
+
+    data, targets, dataset = manager.get_dataset(
+        np.arange(2, 4), source="train", mode="test", appendent=(memory_data, memory_targets), ret_data=True
+    )
+
+    np.testing.assert_array_equal(data, np.concatenate([expected_data, memory_data]))
+    np.testing.assert_array_equal(targets, np.concatenate([expected_targets, memory_targets]))
+    assert dataset.sample_ids is None
+
+
+def test_split_keeps_every_class_sample_once(manager):
+    memory_data, memory_targets = _where_loop(manager._train_data, manager._train_targets, np.arange(0, 4))
+
+    train, val = manager.get_dataset_with_split(
+        np.arange(4, 6), source="train", mode="test", appendent=(memory_data, memory_targets), val_samples_per_class=1
+    )
+
+    expected = np.concatenate([_where_loop(manager._train_data, manager._train_targets, np.arange(4, 6))[1], memory_targets])
+    np.testing.assert_array_equal(np.sort(np.concatenate([train.labels, val.labels])), np.sort(expected))
+    assert np.bincount(val.labels).tolist() == [1] * 6
+
+
+def test_class_frequencies_count_the_mapped_train_targets(manager):
+    expected = [int(np.sum(manager._train_targets == c)) for c in range(manager.nb_classes)]
+
+    assert manager.class_frequencies == expected
@@ -0,0 +1,91 @@
+import torch
+
+from utils.class_stats import ClassStatsStore, GaussianFeatureSampler
+
+
+def _store(rows):
+    store = ClassStatsStore("scales", rows.shape[1:], "cpu")
+    store.append(rows)
+    return store
+
+
+def _collect(sampler, num_per_component, batch_size, num_batches=None):
+    features, labels = zip(*sampler.epoch(num_per_component, batch_size, num_batches))
+    return torch.cat(features), torch.cat(labels)
+
+
+def _class_moments(features, labels, label):
+    rows = features[labels == label].double()
+    return rows.mean(dim=0), torch.cov(rows.t())
+
+
+def test_low_rank_samples_have_the_component_moments():
+    torch.manual_seed(0)
+    num_components, dim, rank = 5, 4, 2
+    means = torch.randn(num_components, dim) * 5
+    factors = torch.randn(num_components, dim, rank)
+    stds = torch.rand(num_components, dim) + 0.5
+    labels = torch.arange(num_components) * 3
+    # small chunks and windows so the epoch spans several of both
+    sampler = GaussianFeatureSampler(means, labels, _store(factors), diags=_store(stds), chunk_size=2, buffer_batches=3)
+
+    features, sampled_labels = _collect(sampler, 20000, 256)
+
+    for c in range(num_components):
+        mean, cov = _class_moments(features, sampled_labels, labels[c])
+        expected_cov = factors[c].double() @ factors[c].double().t() + torch.diag(stds[c].double().pow(2))
+        torch.testing.assert_close(mean, means[c].double(), atol=0.1, rtol=0)
+        torch.testing.assert_close(cov, expected_cov, atol=0.15, rtol=0.05)
+
+
+def test_diagonal_samples_have_the_component_moments():
+    torch.manual_seed(0)
+    means = torch.randn(3, 6)
+    stds = torch.rand(3, 6) + 0.2
+    sampler = GaussianFeatureSampler(means, torch.arange(3), _store(stds), chunk_size=2, buffer_batches=2)
+
+    features, labels = _collect(sampler, 20000, 500)
+
+    for c in range(3):
+        mean, cov = _class_moments(features, labels, c)
+        torch.testing.assert_close(mean, means[c].double(), atol=0.05, rtol=0)
+        torch.testing.assert_close(torch.diagonal(cov), stds[c].double().pow(2), atol=0.05, rtol=0.05)
+        off_diagonal = cov - torch.diag(torch.diagonal(cov))
+        assert off_diagonal.abs().max() < 0.05
+
+
+def test_shared_factors_are_looked_up_by_scale_index():
+    torch.manual_seed(0)
+    means = torch.zeros(4, 3)
+    shared = torch.stack([torch.eye(3) * 0.1, torch.eye(3) * 2.0])
+    scale_index = torch.tensor([0, 1, 1, 0])
+    sampler = GaussianFeatureSampler(means, torch.arange(4), _store(shared), scale_index=scale_index)
+
+    features, labels = _collect(sampler, 10000, 400)
+
+    for c in range(4):
+        _, cov = _class_moments(features, labels, c)
+        expected = (shared[scale_index[c]].double() @ shared[scale_index[c]].double().t())
+        torch.testing.assert_close(cov, expected, atol=0.1, rtol=0.05)
+
+
+def test_epoch_draws_every_component_equally_in_shuffled_batches():
+    torch.manual_seed(0)
+    sampler = GaussianFeatureSampler(torch.randn(7, 2), torch.arange(7), _store(torch.ones(7, 2)), chunk_size=3)
+
+    batches = list(sampler.epoch(10, 8))
+    labels = torch.cat([batch_labels for _, batch_labels in batches])
+
+    assert [features.shape for features, _ in batches[:-1]] == [torch.Size([8, 2])] * (len(batches) - 1)
+    assert torch.bincount(labels).tolist() == [10] * 7
+    # shuffled across components, not drawn component by component
+    assert not torch.equal(labels, torch.sort(labels).values)
+
+
+def test_num_batches_truncates_the_epoch():
+    sampler = GaussianFeatureSampler(torch.zeros(4, 2), torch.arange(4), _store(torch.ones(4, 2)))
+
+    batches = list(sampler.epoch(100, 16, num_batches=5))
+
+    assert len(batches) == 5
+    assert all(features.shape == (16, 2) for features, _ in batches)
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from utils.image_cache import ImageCache, TransformCache
+
+
+def _loader(path):
+    with open(path, "rb") as f:
+        return Image.open(f).convert("RGB")
+
+
+def _write_images(root, sizes):
+    rng = np.random.RandomState(0)
+    paths = []
+    for k, (w, h) in enumerate(sizes):
+        path = str(root / "img_{}.png".format(k))
+        Image.fromarray(rng.randint(0, 256, size=(h, w, 3), dtype=np.uint8)).save(path)
+        paths.append(path)
+    return np.array(paths)
+
+
+def test_cached_images_match_a_resize_of_the_decoded_source(tmp_path):
+    paths = _write_images(tmp_path, [(40, 30), (24, 64), (32, 32)])
+    cache = ImageCache(str(tmp_path / "cache"), "toy", paths[::-1], _loader, short_side=16, num_workers=2)
+
+    for path, row in zip(paths, cache.rows(paths)):
+        source = _loader(path)
+        w, h = source.size
+        scale = 16 / min(w, h)
+        expected = source.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BICUBIC)
+        cached = cache.load(row)
+        assert min(cached.size) == 16
+        np.testing.assert_array_equal(np.asarray(cached), np.asarray(expected))
+
+
+def test_cache_is_reused_and_rebuilt_for_other_images(tmp_path):
+    paths = _write_images(tmp_path, [(20, 20), (30, 20)])
+    root = str(tmp_path / "cache")
+    first = ImageCache(root, "toy", paths, _loader, short_side=8)
+    pixels = np.asarray(first.load(first.rows(paths[:1])[0]))
+
+    reused = ImageCache(root, "toy", paths, _loader, short_side=8)
+    np.testing.assert_array_equal(np.asarray(reused.load(reused.rows(paths[:1])[0])), pixels)
+
+    rebuilt = ImageCache(root, "toy", paths[:1], _loader, short_side=8)
+    assert len(rebuilt.paths) == 1
+    np.testing.assert_array_equal(np.asarray(rebuilt.load(0)), pixels)
+
+
+def test_rows_of_missing_images_raise(tmp_path):
+    paths = _write_images(tmp_path, [(10, 10), (12, 10)])
+    cache = ImageCache(str(tmp_path / "cache"), "toy", paths[:1], _loader, short_side=8)
+
+    with pytest.raises(KeyError):
+        cache.rows(paths)
+    assert len(cache.rows(paths[:0])) == 0
+
+
+def _test_transform():
+    return transforms.Compose([
+        transforms.Resize(12), transforms.CenterCrop(8), transforms.ToTensor(),
+        transforms.Normalize([0.5, 0.5, 0.5], [0.25, 0.25, 0.25]),
+    ])
+
+
+def test_transform_cache_batches_match_the_per_sample_transform(tmp_path):
+    paths = _write_images(tmp_path, [(20, 16), (16, 24), (30, 30)])
+    trsf = _test_transform()
+    cache = TransformCache(str(tmp_path / "test"), len(paths), trsf, "v1")
+
+    # the first pass fills the rows, the second one reads them back
+    for _ in range(2):
+        batch = [(k, cache.load(k, lambda k=k: _loader(paths[k])), k) for k in range(len(paths))]
+        idx, images, labels = cache.collate_fn(batch)
+        assert images.dtype == torch.float32 and images.shape == (3, 3, 8, 8)
+        for k, path in enumerate(paths):
+            torch.testing.assert_close(images[k], trsf(_loader(path)), atol=1e-5, rtol=0)
+    assert idx.tolist() == labels.tolist() == [0, 1, 2]
+
+
+def test_transform_cache_is_rebuilt_for_other_samples(tmp_path):
+    paths = _write_images(tmp_path, [(16, 16)])
+    trsf = _test_transform()
+    TransformCache(str(tmp_path / "test"), 1, trsf, "v1").load(0, lambda: _loader(paths[0]))
+
+    reused = TransformCache(str(tmp_path / "test"), 1, trsf, "v1")
+    reused._open()
+    assert reused._filled[0]
+
+    rebuilt = TransformCache(str(tmp_path / "test"), 1, trsf, "v2")
+    rebuilt._open()
+    assert not rebuilt._filled[0]
@@ -0,0 +1,98 @@
+import gc
+import os
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from utils.loader_service import LoaderService, _stage_path
+
+
+class _Range(Dataset):
+    def __init__(self, num_samples, offset):
+        self.num_samples = num_samples
+        self.offset = offset
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        return idx, torch.full((2,), float(self.offset + idx)), self.offset
+
+
+def _values(loader):
+    return [(idx.tolist(), inputs[:, 0].tolist(), targets.tolist()) for idx, inputs, targets in loader]
+
+
+@pytest.fixture(params=[0, 2], ids=["main_process", "workers"])
+def service(request):
+    return LoaderService(num_workers=request.param, pin_memory=False)
+
+
+def test_stages_yield_the_batches_of_a_dataloader(service):
+    first, second = _Range(10, 0), _Range(7, 100)
+    first_loader = service.loader(first, batch_size=4)
+    second_loader = service.loader(second, batch_size=3)
+
+    # switching back and forth reuses the same workers
+    for _ in range(2):
+        assert _values(first_loader) == _values(DataLoader(first, batch_size=4))
+        assert _values(second_loader) == _values(DataLoader(second, batch_size=3))
+
+
+def test_stage_added_after_the_workers_started(service):
+    _values(service.loader(_Range(5, 0), batch_size=2))
+    late = _Range(6, 50)
+
+    assert _values(service.loader(late, batch_size=4)) == _values(DataLoader(late, batch_size=4))
+
+
+def test_shuffle_and_drop_last(service):
+    loader = service.loader(_Range(10, 0), batch_size=3, shuffle=True, drop_last=True)
+
+    batches = _values(loader)
+
+    assert len(loader) == len(batches) == 3
+    assert all(len(idx) == 3 for idx, _, _ in batches)
+    seen = [i for idx, _, _ in batches for i in idx]
+    assert len(set(seen)) == 9 and set(seen) <= set(range(10))
+
+
+def test_stages_register_on_first_iteration(service):
+    loader = service.loader(_Range(4, 0), batch_size=2)
+    assert loader.stage_id is None and not service._live
+
+    _values(loader)
+    stage_id = loader.stage_id
+    _values(loader)
+
+    assert stage_id is not None and loader.stage_id == stage_id
+    assert service._live == {stage_id}
+
+
+def test_released_stages_are_dropped(service):
+    _values(service.loader(_Range(4, 0), batch_size=2))
+    loader = service.loader(_Range(4, 10), batch_size=2)
+    _values(loader)
+    stage_id = loader.stage_id
+
+    del loader
+    gc.collect()
+
+    assert stage_id not in service._live
+    assert stage_id not in service._dataset.registered
+    assert not os.path.exists(_stage_path(service.root, stage_id))
+    assert _values(service.loader(_Range(3, 20), batch_size=2))[0][2] == [20, 20]
+
+
+def test_only_one_stage_iterates_at_a_time(service):
+    first = service.loader(_Range(6, 0), batch_size=2)
+    second = service.loader(_Range(6, 0), batch_size=2)
+
+    batches = iter(first)
+    next(batches)
+    with pytest.raises(RuntimeError):
+        next(iter(second))
+    batches.close()
+
+    assert len(_values(second)) == 3
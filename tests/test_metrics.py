@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from sklearn.metrics import cohen_kappa_score, f1_score, matthews_corrcoef
+
+from utils.toolkit import ConfusionMetrics, accuracy, f1_score_custom, kappa_score_custom, mcc_score_custom
+
+
+def _predictions(num_classes=30, num_samples=600, seed=0):
+    rng = np.random.RandomState(seed)
+    y_true = rng.randint(0, num_classes, size=num_samples)
+    # mostly right, with errors spread over all classes
+    y_pred = np.where(rng.rand(num_samples) < 0.7, y_true, rng.randint(0, num_classes, size=num_samples))
+    return y_pred, y_true
+
+
+def _accuracy(y_true, y_pred):
+    return (y_pred == y_true).sum() * 100 / len(y_true)
+
+
+REFERENCES = [
+    (accuracy, _accuracy),
+    (f1_score_custom, lambda y_true, y_pred: f1_score(y_true, y_pred, average="weighted")),
+    (mcc_score_custom, matthews_corrcoef),
+    (kappa_score_custom, cohen_kappa_score),
+]
+
+
+def _grouped(reference, y_pred, y_true, nb_old, init_cls, increment):
+    # the per-group np.where selection the metrics used before the confusion matrix
+    groups = {"total": np.arange(len(y_true))}
+    groups["{}-{}".format("00", str(init_cls - 1).rjust(2, "0"))] = np.where(y_true < init_cls)[0]
+    for class_id in range(init_cls, np.max(y_true), increment):
+        label = "{}-{}".format(str(class_id).rjust(2, "0"), str(class_id + increment - 1).rjust(2, "0"))
+        groups[label] = np.where(np.logical_and(y_true >= class_id, y_true < class_id + increment))[0]
+    groups["old"] = np.where(y_true < nb_old)[0]
+    groups["new"] = np.where(y_true >= nb_old)[0]
+    return {label: np.around(reference(y_true[idxes], y_pred[idxes]), decimals=2) for label, idxes in groups.items()}
+
+
+@pytest.mark.parametrize("metric, reference", REFERENCES, ids=["accuracy", "f1", "mcc", "kappa"])
+def test_grouped_metrics_match_the_per_group_sklearn_scores(metric, reference):
+    y_pred, y_true = _predictions()
+
+    got = metric(y_pred, y_true, nb_old=20, init_cls=10, increment=10)
+    expected = _grouped(reference, y_pred, y_true, nb_old=20, init_cls=10, increment=10)
+
+    assert list(got) == list(expected)
+    for label in expected:
+        assert got[label] == pytest.approx(expected[label], abs=0.011), label
+
+
+def test_scores_of_an_empty_group_are_zero():
+    y_pred, y_true = _predictions(num_classes=10)
+
+    assert ConfusionMetrics(y_pred, y_true).score("accuracy", 10, 20) == 0
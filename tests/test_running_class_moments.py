@@ -0,0 +1,55 @@
+import numpy as np
+import torch
+
+from utils.class_stats import RunningClassMoments
+
+
+def _stream(moments, features, labels, batch_size):
+    for start in range(0, features.shape[0], batch_size):
+        moments.update(torch.from_numpy(features[start:start + batch_size]), torch.from_numpy(labels[start:start + batch_size]))
+    return moments
+
+
+def _data(num_classes=4, num_samples=503, dim=6, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, num_classes, size=num_samples)
+    # large offsets make a naive sum of squares lose precision
+    features = rng.randn(num_samples, dim) * (labels[:, None] + 1) + 1000 * labels[:, None]
+    return features.astype(np.float32), labels
+
+
+def test_full_covariance_matches_np_cov_per_class():
+    features, labels = _data()
+    moments = _stream(RunningClassMoments(4, 6, "cpu"), features, labels, batch_size=37)
+
+    for c in range(4):
+        rows = features[labels == c].astype(np.float64)
+        np.testing.assert_allclose(moments.count[c].item(), rows.shape[0])
+        np.testing.assert_allclose(moments.mean[c].numpy(), rows.mean(axis=0), rtol=1e-10, atol=1e-8)
+        np.testing.assert_allclose(moments.covariance()[c].numpy(), np.cov(rows, rowvar=False), rtol=1e-8, atol=1e-8)
+
+
+def test_diagonal_matches_np_var_per_class():
+    features, labels = _data(seed=1)
+    moments = _stream(RunningClassMoments(4, 6, "cpu", full_cov=False), features, labels, batch_size=16)
+
+    for c in range(4):
+        rows = features[labels == c].astype(np.float64)
+        np.testing.assert_allclose(moments.covariance()[c].numpy(), rows.var(axis=0, ddof=1), rtol=1e-8, atol=1e-8)
+
+
+def test_result_does_not_depend_on_batching():
+    features, labels = _data(seed=2)
+    whole = _stream(RunningClassMoments(4, 6, "cpu"), features, labels, batch_size=len(labels))
+    single = _stream(RunningClassMoments(4, 6, "cpu"), features, labels, batch_size=1)
+
+    torch.testing.assert_close(single.mean, whole.mean)
+    torch.testing.assert_close(single.covariance(), whole.covariance())
+
+
+def test_classes_without_samples_stay_zero():
+    features, labels = _data(num_classes=3, seed=3)
+    moments = _stream(RunningClassMoments(5, 6, "cpu"), features, labels, batch_size=50)
+
+    assert moments.count[3:].sum() == 0
+    assert torch.count_nonzero(moments.covariance()[3:]) == 0
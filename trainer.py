@@ -198,8 +198,10 @@ def _train(args):
 
         model.incremental_train(data_manager)
 
-
-        cnn_accy, nme_accy = model.eval_task("accuracy")
+        # one inference sweep serves accuracy and every imbalance metric
+        eval_metrics = ["accuracy"] + (list(imb_curves.keys()) if imb_metrics else [])
+        eval_results = model.eval_task(eval_metrics)
+        cnn_accy, nme_accy = eval_results["accuracy"]
         model.after_task()
 
         if nme_accy is not None:
@@ -228,7 +230,7 @@ def _train(args):
             if imb_metrics:
                 print("\n### Imbalance Metrics ###")
                 for metric in ["f1_score", "mcc", "kappa", "balanced_accuracy"]:
-                    metric_result = model.eval_task(metric)
+                    metric_result = eval_results[metric]
                     print(f"{metric.upper()} (CNN):", metric_result[0]["top1"])
                     imb_curves[metric].append( metric_result[0]["top1"])  # Store for averaging
                     if nme_accy is not None:
@@ -250,7 +252,7 @@ def _train(args):
             if imb_metrics:
                 print("\n### Imbalance Metrics ###")
                 for metric in ["f1_score", "mcc", "kappa", "balanced_accuracy"]:
-                    metric_result = model.eval_task(metric)
+                    metric_result = eval_results[metric]
                     imb_curves[metric].append( metric_result[0]["top1"]) 
                     imb_matrices[metric].append(metric_result[0]["grouped"].values())
                     print(f"Average {metric.upper()} (CNN):", sum(imb_curves[metric])/len(imb_curves[metric]))
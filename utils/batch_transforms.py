@@ -0,0 +1,113 @@
+import math
+import torch
+from torchvision import transforms
+from torchvision.ops import roi_align
+
+
+class BatchAugment(object):
+    """
+    Batched equivalent of [RandomResizedCrop, RandomHorizontalFlip, ToTensor, *tensor transforms], used as the
+    collate_fn of a dataset whose samples are uint8 CxHxW tensors (transforms.PILToTensor).
+
+    Crop boxes are drawn per sample as in RandomResizedCrop, then all crops are resized in one roi_align call
+    on the edge-padded batch, flipped with one mask and scaled to [0, 1]. Samples of different sizes are fine.
+    """
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), flip_p=0.5, tensor_trsf=None, num_trials=10):
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.ratio = ratio
+        self.flip_p = flip_p
+        self.tensor_trsf = tensor_trsf
+        self.num_trials = num_trials
+
+    @classmethod
+    def from_transforms(cls, trsf):
+        """
+        Args:
+            trsf (list): Per-sample transform list, e.g. a train_trsf of utils/data.py.
+
+        Returns:
+            BatchAugment: The batched equivalent, or None if trsf is not of the supported form.
+        """
+        trsf = list(trsf)
+        if len(trsf) < 2 or not isinstance(trsf[0], transforms.RandomResizedCrop):
+            return None
+        crop, rest = trsf[0], trsf[1:]
+        flip_p = 0.0
+        if isinstance(rest[0], transforms.RandomHorizontalFlip):
+            flip_p, rest = rest[0].p, rest[1:]
+        if len(rest) == 0 or not isinstance(rest[0], transforms.ToTensor):
+            return None
+        tensor_trsf = transforms.Compose(rest[1:]) if len(rest) > 1 else None
+        return cls(crop.size, crop.scale, crop.ratio, flip_p, tensor_trsf)
+
+    def crop_boxes(self, heights, widths):
+        """
+        RandomResizedCrop.get_params for a whole batch.
+
+        Args:
+            heights (torch.Tensor): Image heights [B]
+            widths (torch.Tensor): Image widths [B]
+
+        Returns:
+            torch.Tensor: Crop boxes as (x1, y1, x2, y2) [B, 4]
+        """
+        heights, widths = heights.float(), widths.float()
+        batch = heights.shape[0]
+        area = (heights * widths).unsqueeze(1)
+        target_area = area * torch.empty(batch, self.num_trials).uniform_(*self.scale)
+        aspect = torch.exp(torch.empty(batch, self.num_trials).uniform_(*self.log_ratio))
+        w = torch.sqrt(target_area * aspect).round()
+        h = torch.sqrt(target_area / aspect).round()
+        valid = (w > 0) & (h > 0) & (w <= widths.unsqueeze(1)) & (h <= heights.unsqueeze(1))
+        trial = valid.float().argmax(dim=1, keepdim=True)
+        w, h = w.gather(1, trial).squeeze(1), h.gather(1, trial).squeeze(1)
+        i = torch.floor(torch.rand(batch) * (heights - h + 1))
+        j = torch.floor(torch.rand(batch) * (widths - w + 1))
+
+        # fallback to a central crop of the closest allowed ratio
+        in_ratio = widths / heights
+        fw = torch.where(in_ratio > self.ratio[1], (heights * self.ratio[1]).round(), widths)
+        fh = torch.where(in_ratio < self.ratio[0], (widths / self.ratio[0]).round(), heights)
+        found = valid.any(dim=1)
+        w, h = torch.where(found, w, fw), torch.where(found, h, fh)
+        i = torch.where(found, i, torch.div(heights - fh, 2, rounding_mode="floor"))
+        j = torch.where(found, j, torch.div(widths - fw, 2, rounding_mode="floor"))
+        return torch.stack([j, i, j + w, i + h], dim=1)
+
+    def resized_crops(self, images, boxes):
+        """
+        Crops every image to its box and resizes it to self.size, all in one roi_align call.
+
+        Args:
+            images (list): uint8 images [3, H_i, W_i] of any sizes
+            boxes (torch.Tensor): Crop boxes as (x1, y1, x2, y2), within their image [B, 4]
+
+        Returns:
+            torch.Tensor: Resized crops, in [0, 255] [B, 3, *self.size]
+        """
+        height = max(img.shape[1] for img in images)
+        width = max(img.shape[2] for img in images)
+        padded = torch.empty(len(images), 3, height, width, dtype=torch.uint8)
+        for k, img in enumerate(images):
+            h, w = img.shape[1], img.shape[2]
+            # edge-replicated rather than zero padding: roi_align only clamps at the border of the padded batch,
+            # so crops touching the right or bottom edge of a smaller image would interpolate into the padding
+            padded[k, :, :h, :w] = img
+            padded[k, :, :h, w:] = img[:, :, w - 1:w]
+            padded[k, :, h:, :] = padded[k, :, h - 1:h, :]
+        rois = torch.cat([torch.arange(len(images), dtype=torch.float).unsqueeze(1), boxes.float()], dim=1)
+        # sampling_ratio=-1 averages over ceil(box / output) points per bin, i.e. antialiased when downscaling
+        return roi_align(padded.float(), rois, self.size, spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+    def __call__(self, batch):
+        idx, images, labels = zip(*batch)
+        heights = torch.tensor([img.shape[1] for img in images])
+        widths = torch.tensor([img.shape[2] for img in images])
+        out = self.resized_crops(images, self.crop_boxes(heights, widths))
+        flip = torch.rand(len(images)) < self.flip_p
+        out = torch.where(flip.view(-1, 1, 1, 1), out.flip(-1), out).div_(255)
+        if self.tensor_trsf is not None:
+            out = self.tensor_trsf(out)
+        return torch.as_tensor(idx), out, torch.as_tensor(labels)
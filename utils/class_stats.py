@@ -0,0 +1,345 @@
+import contextlib
+import itertools
+import os
+import queue
+import tempfile
+import threading
+import weakref
+import numpy as np
+import torch
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ClassStatsStore(object):
+    """
+    Rows of per-component class statistics (e.g. the sampling factors of classifier alignment),
+    kept in one contiguous array per tier.
+
+    New rows are appended to the device tier, whose capacity grows geometrically. spill() moves them to the spill tier, which is pinned host memory
+    for tier="host" or a memory-mapped file under root for tier="disk"; with tier="device" nothing is spilled.
+    chunks() streams all rows back to the device, loading the next spilled chunk while the current one is in use.
+    """
+    def __init__(self, name, row_shape, device, tier="device", root=None):
+        if tier not in ("device", "host", "disk"):
+            raise ValueError("Unknown class statistics tier {}.".format(tier))
+        if tier == "disk" and root is None:
+            raise ValueError("The disk tier needs a directory (class_stats_dir).")
+        self.row_shape = tuple(row_shape)
+        self.device = torch.device(device)
+        self.tier = tier
+        self._hot = None
+        self.num_hot = 0
+        self.cold = None
+        self.num_cold = 0
+        self._pin = self.device.type == "cuda"
+        self._copy_stream = torch.cuda.Stream(device=self.device) if self._pin and tier != "device" else None
+        self.path = None
+        if tier == "disk":
+            os.makedirs(root, exist_ok=True)
+            # a unique file per store, removed with the store (e.g. when the learner replaces it) or at exit
+            fd, self.path = tempfile.mkstemp(prefix="{}_".format(name), suffix=".bin", dir=root)
+            os.close(fd)
+            weakref.finalize(self, _remove_file, self.path)
+
+    def __len__(self):
+        return self.num_cold + self.num_hot
+
+    @property
+    def hot(self):
+        # rows of the device tier, None if it is empty
+        return self._hot[:self.num_hot] if self.num_hot > 0 else None
+
+    def append(self, rows):
+        self.allocate(rows.shape[0]).copy_(rows)
+
+    def allocate(self, num_rows):
+        """
+        Appends num_rows uninitialized rows to the device tier, to be filled in place.
+
+        Returns:
+            torch.Tensor: The new rows [num_rows, *row_shape]
+        """
+        capacity = 0 if self._hot is None else self._hot.shape[0]
+        if self.num_hot + num_rows > capacity:
+            # doubling keeps the copies of earlier rows amortized over the tasks
+            hot = torch.empty((max(self.num_hot + num_rows, 2 * capacity),) + self.row_shape, device=self.device)
+            if self.num_hot > 0:
+                hot[:self.num_hot].copy_(self._hot[:self.num_hot])
+            self._hot = hot
+        rows = self._hot[self.num_hot:self.num_hot + num_rows]
+        self.num_hot += num_rows
+        return rows
+
+    def spill(self):
+        """
+        Moves the device tier to the spill tier.
+        """
+        if self.tier == "device" or self.hot is None:
+            return
+        num_rows = self.hot.shape[0]
+        self._reserve(self.num_cold + num_rows)
+        rows = self.hot.cpu()
+        if self.tier == "disk":
+            self.cold[self.num_cold:self.num_cold + num_rows] = rows.numpy()
+            self.cold.flush()
+        else:
+            self.cold[self.num_cold:self.num_cold + num_rows].copy_(rows)
+        self.num_cold += num_rows
+        self._hot, self.num_hot = None, 0
+
+    def chunks(self, chunk_size):
+        """
+        Yields:
+            int: Index of the first row of the chunk
+            torch.Tensor: Rows of the chunk on the device [<= chunk_size, *row_shape]
+        """
+        pending = self._prefetch(0, min(chunk_size, self.num_cold)) if self.num_cold > 0 else None
+        for start in range(0, self.num_cold, chunk_size):
+            end = min(start + chunk_size, self.num_cold)
+            rows = self._wait(pending)
+            if end < self.num_cold:
+                pending = self._prefetch(end, min(end + chunk_size, self.num_cold))
+            yield start, rows
+        if self.hot is not None:
+            for start in range(0, self.hot.shape[0], chunk_size):
+                yield self.num_cold + start, self.hot[start:start + chunk_size]
+
+    def load(self):
+        # all rows on the device at once, for stores that are known to be small
+        return torch.cat([rows for _, rows in self.chunks(max(len(self), 1))], dim=0)
+
+    def _reserve(self, num_rows):
+        capacity = 0 if self.cold is None else self.cold.shape[0]
+        if num_rows <= capacity:
+            return
+        capacity = max(num_rows, 2 * capacity)
+        if self.tier == "disk":
+            # grow the file in place and map it again; the spilled rows stay where they are
+            with open(self.path, "r+b") as f:
+                f.truncate(capacity * int(np.prod(self.row_shape)) * 4)
+            self.cold = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity,) + self.row_shape)
+        else:
+            cold = torch.empty((capacity,) + self.row_shape, dtype=torch.float32, pin_memory=self._pin)
+            if self.num_cold > 0:
+                cold[:self.num_cold].copy_(self.cold[:self.num_cold])
+            self.cold = cold
+
+    def _prefetch(self, start, end):
+        if self.tier == "disk":
+            host = torch.from_numpy(np.ascontiguousarray(self.cold[start:end]))
+            if self._pin:
+                host = host.pin_memory()
+        else:
+            host = self.cold[start:end]
+        if self._copy_stream is None:
+            return host.to(self.device), None, host
+        with torch.cuda.stream(self._copy_stream):
+            rows = host.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self._copy_stream)
+        # keep the host buffer alive until the copy has been waited for
+        return rows, event, host
+
+    def _wait(self, pending):
+        rows, event, _ = pending
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+            rows.record_stream(torch.cuda.current_stream(self.device))
+        return rows
+
+
+class GaussianFeatureSampler(object):
+    """
+    Streams shuffled mini-batches of synthetic features drawn from stacked Gaussian components.
+
+    Each epoch draws num_per_component samples from every component in a random global order, as if all of them
+    were sampled and shuffled at once, but only a window of buffer_batches mini-batches is materialized at a time.
+    The epoch is planned on the host; a background thread draws the next window on the device, streaming the
+    component factors from their ClassStatsStores, while the current one is consumed. Memory is bounded by a chunk
+    of draws and a few windows, whatever the class count.
+    """
+    def __init__(self, means, labels, scales, diags=None, scale_index=None, chunk_size=64, buffer_batches=32):
+        self.means = means  # [N, D]
+        self.labels = labels  # [N]
+        self.scales = scales  # ClassStatsStore of [N, D, k] factors or [N, D] stds, or per scale_index entry
+        self.diags = diags  # optional ClassStatsStore of residual stds [N, D]
+        self.scale_index = scale_index  # optional [N] index of the shared factor of each component
+        self.chunk_size = chunk_size
+        self.buffer_batches = buffer_batches
+        self.device = means.device
+        if scale_index is not None:
+            # shared factors are few (e.g. one per task), so they are loaded once
+            self._shared = (scales.load(), diags.load() if diags is not None else None)
+
+    def epoch(self, num_per_component, batch_size, num_batches=None):
+        """
+        Yields:
+            torch.Tensor: Sampled features [batch_size, D]
+            torch.Tensor: Class labels of the samples [batch_size]
+        """
+        plan = torch.arange(self.means.shape[0]).repeat_interleave(num_per_component)
+        plan = plan[torch.randperm(plan.shape[0])]
+        if num_batches is not None:
+            plan = plan[:num_batches * batch_size]
+        window = self.buffer_batches * batch_size
+
+        buffer, stop = queue.Queue(maxsize=1), threading.Event()
+        producer = threading.Thread(target=self._produce, args=(plan, window, buffer, stop), daemon=True)
+        producer.start()
+        try:
+            for _ in range(0, plan.shape[0], window):
+                item = buffer.get()
+                if isinstance(item, BaseException):
+                    raise item
+                features, components, event = item
+                if event is not None:
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    features.record_stream(torch.cuda.current_stream(self.device))
+                    components.record_stream(torch.cuda.current_stream(self.device))
+                for start in range(0, features.shape[0], batch_size):
+                    yield features[start:start + batch_size], self.labels[components[start:start + batch_size]]
+        finally:
+            stop.set()
+            while producer.is_alive():
+                try:
+                    buffer.get_nowait()
+                except queue.Empty:
+                    pass
+                producer.join(timeout=0.1)
+
+    def _produce(self, plan, window, buffer, stop):
+        stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+        try:
+            # grad mode and the current stream are thread-local
+            if stream is not None:
+                # the means and factors may still be written on the consumer's stream
+                stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.no_grad(), torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                for start in range(0, plan.shape[0], window):
+                    features, components = self._draw(plan[start:start + window])
+                    event = None
+                    if stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    if not self._put(buffer, (features, components, event), stop):
+                        return
+        except BaseException as e:
+            self._put(buffer, e, stop)
+
+    def _put(self, buffer, item, stop):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _chunks(self):
+        if self.scale_index is not None:
+            scales, diags = self._shared
+            for start in range(0, self.means.shape[0], self.chunk_size):
+                index = self.scale_index[start:start + self.chunk_size]
+                yield start, scales[index], diags[index] if diags is not None else None
+        else:
+            diag_chunks = self.diags.chunks(self.chunk_size) if self.diags is not None else itertools.repeat((None, None))
+            for (start, scales), (_, diags) in zip(self.scales.chunks(self.chunk_size), diag_chunks):
+                yield start, scales, diags
+
+    def _draw(self, components):
+        """
+        Draws one sample for each entry of components [P], one batched matmul per chunk of components.
+        Low-rank components are drawn from their factored form, mean + W z + sqrt(r) * e, without forming W W^T.
+
+        Args:
+            components (torch.Tensor): Host tensor of the component of every sample, in window order [P]
+
+        Returns:
+            torch.Tensor: Samples on the device [P, D]
+            torch.Tensor: components on the device [P]
+        """
+        num_components, dim = self.means.shape
+        # the window is planned on the host, so the per-chunk bookkeeping needs no device sync
+        counts = torch.bincount(components, minlength=num_components)
+        sorted_components, order = torch.sort(components, stable=True)
+        ends = torch.cumsum(counts, dim=0).tolist()
+        non_blocking = self.device.type == "cuda"
+        if non_blocking:
+            components, order = components.pin_memory(), order.pin_memory()
+        order = order.to(self.device, non_blocking=non_blocking)
+        features = torch.empty(components.shape[0], dim, device=self.device)
+
+        for start, scales, diags in self._chunks():
+            end = start + scales.shape[0]
+            low, high = ends[start - 1] if start > 0 else 0, ends[end - 1]
+            if low == high:
+                continue
+            chunk_counts = counts[start:end]
+            num_samples = int(chunk_counts.max())
+            means = self.means[start:end].unsqueeze(1)
+            if scales.dim() == 3:
+                noise = torch.randn(scales.shape[0], num_samples, scales.shape[-1], device=self.device)
+                samples = means + torch.matmul(noise, scales.transpose(1, 2))
+            else:
+                noise = torch.randn(scales.shape[0], num_samples, dim, device=self.device)
+                samples = means + noise * scales.unsqueeze(1)
+            # the first count samples of every component, component-major as in the sorted window
+            keep = torch.arange(num_samples) < chunk_counts.unsqueeze(1)
+            samples = samples[keep.to(self.device, non_blocking=non_blocking)]
+            if diags is not None:
+                local = (sorted_components[low:high] - start).to(self.device, non_blocking=non_blocking)
+                samples += torch.randn(high - low, dim, device=self.device) * diags[local]
+            features[order[low:high]] = samples
+        return features, components.to(self.device, non_blocking=non_blocking)
+
+
+class RunningClassMoments(object):
+    """
+    Per-class running mean and covariance (or variance), merged batch by batch with the pairwise Welford update
+    of Chan et al., so a pass over a loader needs O(C * D^2) memory whatever the number of samples.
+    """
+    def __init__(self, num_classes, dim, device, full_cov=True):
+        self.full_cov = full_cov
+        self.count = torch.zeros(num_classes, dtype=torch.float64, device=device)
+        self.mean = torch.zeros(num_classes, dim, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros((num_classes, dim, dim) if full_cov else (num_classes, dim), dtype=torch.float64, device=device)
+
+    @torch.no_grad()
+    def update(self, features, labels):
+        """
+        Args:
+            features (torch.Tensor): Batch of features [B, D]
+            labels (torch.Tensor): Class of each row, in [0, num_classes) [B]
+        """
+        features = features.double()
+        classes, inverse, batch_count = torch.unique(labels, return_inverse=True, return_counts=True)
+        batch_mean = torch.zeros(classes.shape[0], features.shape[1], dtype=torch.float64, device=features.device)
+        batch_mean = batch_mean.index_add_(0, inverse, features) / batch_count.unsqueeze(1)
+        centered = features - batch_mean[inverse]
+        if self.full_cov:
+            groups = centered[torch.argsort(inverse)].split(batch_count.tolist())
+            batch_m2 = torch.stack([torch.matmul(g.t(), g) for g in groups], dim=0)
+        else:
+            batch_m2 = torch.zeros_like(batch_mean).index_add_(0, inverse, centered.pow(2))
+
+        count_a, count_b = self.count[classes], batch_count.double()
+        count = count_a + count_b
+        delta = batch_mean - self.mean[classes]
+        correction = count_a * count_b / count
+        self.mean[classes] += delta * (count_b / count).unsqueeze(1)
+        if self.full_cov:
+            self.m2[classes] += batch_m2 + correction.view(-1, 1, 1) * delta.unsqueeze(2) * delta.unsqueeze(1)
+        else:
+            self.m2[classes] += batch_m2 + correction.unsqueeze(1) * delta.pow(2)
+        self.count[classes] = count
+
+    def covariance(self):
+        # unbiased, as torch.cov; [C, D, D], or the variances [C, D] if not full_cov
+        denom = (self.count - 1).clamp(min=1)
+        return self.m2 / (denom.view(-1, 1, 1) if self.full_cov else denom.unsqueeze(1))
@@ -1,8 +1,13 @@
+import hashlib
 import logging
+import os
 import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms
+from utils.batch_transforms import BatchAugment
+from utils.loader_service import LoaderService
+from utils.image_cache import ImageCache, TransformCache, split_cacheable_transform
 from utils.data import iCIFAR10, iCIFAR100, iImageNet100, iImageNet1000, iCIFAR224, iImageNetR,iImageNetA,CUB, objectnet, omnibenchmark, vtab,iImageNetR_imbalanced, iCIFAR224_imbalanced,CUB_imbalanced, vtab_imbalanced, MedMNIST
 
 
@@ -10,6 +15,7 @@ class DataManager(object):
     def __init__(self, dataset_name, shuffle, seed, init_cls, increment, args):
         self.args = args
         self.dataset_name = dataset_name
+        self._loader_service = None
         self._setup_data(dataset_name, shuffle, seed)
         assert init_cls <= len(self._class_order), "No enough classes."
         self._increments = [init_cls]
@@ -23,6 +29,20 @@ class DataManager(object):
     def nb_tasks(self):
         return len(self._increments)
 
+    def loader(self, dataset, batch_size, shuffle=False, drop_last=False):
+        """
+        DataLoader replacement served by one persistent worker pool per DataManager.
+        Workers, prefetch depth and pinning come from loader_workers (default: CPU count, at most 8),
+        loader_prefetch and loader_pin_memory (default: CUDA available).
+        """
+        if self._loader_service is None:
+            self._loader_service = LoaderService(
+                num_workers=self.args.get("loader_workers"),
+                prefetch_factor=self.args.get("loader_prefetch", 2),
+                pin_memory=self.args.get("loader_pin_memory"),
+            )
+        return self._loader_service.loader(dataset, batch_size, shuffle=shuffle, drop_last=drop_last)
+
     def get_task_size(self, task):
         return self._increments[task]
 
@@ -37,14 +57,8 @@ class DataManager(object):
         """
         if not hasattr(self, '_train_targets') or self._train_targets is None:
             raise AttributeError("Training targets (_train_targets) are not initialized.")
-        
-        max_class = max(self._train_targets)  # Determine the maximum class label
-        class_counts = [0] * (max_class + 1)  # Create a list initialized to zeros for all classes
-    
-        for label in self._train_targets:  # Iterate over the training targets
-            class_counts[label] += 1
-    
-        return class_counts
+
+        return np.bincount(self._train_targets).tolist()
 
     
             
@@ -58,8 +72,9 @@ class DataManager(object):
         else:
             raise ValueError("Unknown data source {}.".format(source))
 
+        collate_fn = None
         if mode == "train":
-            trsf = transforms.Compose([*self._train_trsf, *self._common_trsf])
+            trsf, collate_fn = self._train_transform()
         elif mode == "flip":
             trsf = transforms.Compose(
                 [
@@ -73,30 +88,95 @@ class DataManager(object):
         else:
             raise ValueError("Unknown mode {}.".format(mode))
 
-        data, targets = [], []
-        for idx in indices:
-            if m_rate is None:
-                class_data, class_targets = self._select(
-                    x, y, low_range=idx, high_range=idx + 1
-                )
-            else:
+        # Position of each sample in its source split, unknown once samples are subsampled or appended.
+        data, targets, sample_ids = [], [], None
+        if m_rate is None:
+            sample_ids = self._class_indices(source, indices)
+        else:
+            for idx in indices:
                 class_data, class_targets = self._select_rmm(
-                    x, y, low_range=idx, high_range=idx + 1, m_rate=m_rate
+                    source, low_range=idx, high_range=idx + 1, m_rate=m_rate
                 )
-            data.append(class_data)
-            targets.append(class_targets)
+                data.append(class_data)
+                targets.append(class_targets)
 
-        if appendent is not None and len(appendent) != 0:
+        if appendent is not None and len(appendent) != 0 and len(appendent[0]) != 0:
             appendent_data, appendent_targets = appendent
+            if sample_ids is not None:
+                data, targets, sample_ids = [x[sample_ids]], [y[sample_ids]], None
             data.append(appendent_data)
             targets.append(appendent_targets)
 
-        data, targets = np.concatenate(data), np.concatenate(targets)
-
+        # Without subsampling or appended samples the dataset is an index view into the source split
+        if sample_ids is not None:
+            data, targets = x, y
+        else:
+            data, targets = np.concatenate(data), np.concatenate(targets)
+
+        # Features are only reusable across calls when the transform is deterministic.
+        cache_key = None
+        if sample_ids is not None and mode == "test":
+            cache_key = (self.dataset_name, source, len(y), repr(trsf), self._image_cache_size, self._fingerprint(source))
+        # transform outputs are only cached for the test split, which is evaluated after every task
+        transform_cache = None
+        if cache_key is not None and source == "test":
+            transform_cache = self._transform_cache(cache_key, trsf)
+        if transform_cache is not None:
+            collate_fn = transform_cache.collate_fn
+
+        dataset = DummyDataset(
+            data, targets, trsf, self.use_path, sample_ids=sample_ids, cache_key=cache_key,
+            image_cache=self._image_cache, transform_cache=transform_cache, collate_fn=collate_fn, indices=sample_ids,
+        )
         if ret_data:
-            return data, targets, DummyDataset(data, targets, trsf, self.use_path)
+            if sample_ids is not None:
+                return data[sample_ids], targets[sample_ids], dataset
+            return data, targets, dataset
         else:
-            return DummyDataset(data, targets, trsf, self.use_path)
+            return dataset
+
+    def _train_transform(self):
+        # with batch_augment the random crop, flip and scaling run per batch in the collate step on uint8 tensors
+        if self.args.get("batch_augment", False):
+            batch_trsf = BatchAugment.from_transforms([*self._train_trsf, *self._common_trsf])
+            if batch_trsf is not None:
+                return transforms.PILToTensor(), batch_trsf
+            logging.info("batch_augment does not support {}, using per-sample transforms.".format(self._train_trsf))
+        return transforms.Compose([*self._train_trsf, *self._common_trsf]), None
+
+    def _transform_cache(self, cache_key, trsf):
+        # persisted uint8 outputs of a deterministic transform, shared by every dataset built over the same split
+        if not self.args.get("test_cache_dir") or split_cacheable_transform(trsf) is None:
+            return None
+        if cache_key not in self._transform_caches:
+            root = self.args["test_cache_dir"]
+            os.makedirs(root, exist_ok=True)
+            # the file is named without the fingerprint, which is checked inside it, so changed samples rebuild it
+            digest = hashlib.sha1(repr(cache_key[:-1]).encode()).hexdigest()[:16]
+            path = os.path.join(root, "{}_{}_{}".format(cache_key[0], cache_key[1], digest))
+            logging.info("Transform cache for {} {}: {}.npy".format(cache_key[0], cache_key[1], path))
+            self._transform_caches[cache_key] = TransformCache(path, cache_key[2], trsf, cache_key[-1])
+        return self._transform_caches[cache_key]
+
+    def _fingerprint(self, source):
+        """
+        Hash of a source split's samples (paths with their size and mtime, or the decoded arrays) and targets,
+        tying persisted caches to the data they were built from. None when no cache is persisted.
+        """
+        if not (self.args.get("test_cache_dir") or self.args.get("feature_cache_dir")):
+            return None
+        if source not in self._fingerprints:
+            x, y = (self._train_data, self._train_targets) if source == "train" else (self._test_data, self._test_targets)
+            digest = hashlib.sha1()
+            if self.use_path:
+                for path in x:
+                    stat = os.stat(path)
+                    digest.update("{}:{}:{}\n".format(path, stat.st_size, stat.st_mtime_ns).encode())
+            else:
+                digest.update(np.ascontiguousarray(x).data)
+            digest.update(np.ascontiguousarray(y, dtype=np.int64).data)
+            self._fingerprints[source] = digest.hexdigest()
+        return self._fingerprints[source]
 
     def get_dataset_with_split(
         self, indices, source, mode, appendent=None, val_samples_per_class=0
@@ -108,8 +188,9 @@ class DataManager(object):
         else:
             raise ValueError("Unknown data source {}.".format(source))
 
+        collate_fn = None
         if mode == "train":
-            trsf = transforms.Compose([*self._train_trsf, *self._common_trsf])
+            trsf, collate_fn = self._train_transform()
         elif mode == "test":
             trsf = transforms.Compose([*self._test_trsf, *self._common_trsf])
         else:
@@ -118,9 +199,8 @@ class DataManager(object):
         train_data, train_targets = [], []
         val_data, val_targets = [], []
         for idx in indices:
-            class_data, class_targets = self._select(
-                x, y, low_range=idx, high_range=idx + 1
-            )
+            class_idxes = self._class_indices(source, [idx])
+            class_data, class_targets = x[class_idxes], y[class_idxes]
             val_indx = np.random.choice(
                 len(class_data), val_samples_per_class, replace=False
             )
@@ -132,10 +212,11 @@ class DataManager(object):
 
         if appendent is not None:
             appendent_data, appendent_targets = appendent
-            for idx in range(0, int(np.max(appendent_targets)) + 1):
-                append_data, append_targets = self._select(
-                    appendent_data, appendent_targets, low_range=idx, high_range=idx + 1
-                )
+            num_appendent_classes = int(np.max(appendent_targets)) + 1
+            appendent_index = _class_index(appendent_targets, num_appendent_classes)
+            for idx in range(0, num_appendent_classes):
+                append_idxes = _take_classes(appendent_index, [idx])
+                append_data, append_targets = appendent_data[append_idxes], appendent_targets[append_idxes]
                 val_indx = np.random.choice(
                     len(append_data), val_samples_per_class, replace=False
                 )
@@ -151,8 +232,8 @@ class DataManager(object):
         val_data, val_targets = np.concatenate(val_data), np.concatenate(val_targets)
 
         return DummyDataset(
-            train_data, train_targets, trsf, self.use_path
-        ), DummyDataset(val_data, val_targets, trsf, self.use_path)
+            train_data, train_targets, trsf, self.use_path, image_cache=self._image_cache, collate_fn=collate_fn
+        ), DummyDataset(val_data, val_targets, trsf, self.use_path, image_cache=self._image_cache, collate_fn=collate_fn)
 
     def _setup_data(self, dataset_name, shuffle, seed):
         idata = _get_idata(dataset_name, self.args)
@@ -163,6 +244,22 @@ class DataManager(object):
         self._test_data, self._test_targets = idata.test_data, idata.test_targets
         self.use_path = idata.use_path
 
+        self._transform_caches = dict()
+        self._fingerprints = dict()
+
+        # Decode path-based images once into a shared uint8 cache at a fixed short side
+        self._image_cache, self._image_cache_size = None, None
+        if self.use_path and self.args.get("image_cache_dir"):
+            self._image_cache_size = self.args.get("image_cache_size", 256)
+            self._image_cache = ImageCache(
+                self.args["image_cache_dir"],
+                dataset_name.lower(),
+                np.concatenate([self._train_data, self._test_data]),
+                pil_loader,
+                short_side=self._image_cache_size,
+                num_workers=self.args.get("image_cache_workers"),
+            )
+
         # Transforms
         self._train_trsf = idata.train_trsf
         self._test_trsf = idata.test_trsf
@@ -184,21 +281,31 @@ class DataManager(object):
         )
         self._test_targets = _map_new_class_index(self._test_targets, self._class_order)
 
-    def _select(self, x, y, low_range, high_range):
-        idxes = np.where(np.logical_and(y >= low_range, y < high_range))[0]
-        return x[idxes], y[idxes]
+        # Class -> sample positions of each split, CSR style
+        self._class_index = {
+            "train": _class_index(self._train_targets, len(self._class_order)),
+            "test": _class_index(self._test_targets, len(self._class_order)),
+        }
+
+    def _class_indices(self, source, indices):
+        """
+        Positions in the source split of the samples of the given classes, class by class in ascending
+        position within a class. A view into the class index when the classes are consecutive.
+        """
+        return _take_classes(self._class_index[source], indices)
 
-    def _select_rmm(self, x, y, low_range, high_range, m_rate):
+    def _select_rmm(self, source, low_range, high_range, m_rate):
         assert m_rate is not None
+        x, y = (self._train_data, self._train_targets) if source == "train" else (self._test_data, self._test_targets)
+        idxes = self._class_indices(source, np.arange(low_range, high_range))
         if m_rate != 0:
-            idxes = np.where(np.logical_and(y >= low_range, y < high_range))[0]
             selected_idxes = np.random.randint(
                 0, len(idxes), size=int((1 - m_rate) * len(idxes))
             )
             new_idxes = idxes[selected_idxes]
             new_idxes = np.sort(new_idxes)
         else:
-            new_idxes = np.where(np.logical_and(y >= low_range, y < high_range))[0]
+            new_idxes = idxes
         return x[new_idxes], y[new_idxes]
 
     def getlen(self, index):
@@ -207,28 +314,79 @@ class DataManager(object):
 
 
 class DummyDataset(Dataset):
-    def __init__(self, images, labels, trsf, use_path=False):
+    def __init__(
+        self, images, labels, trsf, use_path=False, sample_ids=None, cache_key=None, image_cache=None, transform_cache=None,
+        collate_fn=None, indices=None,
+    ):
         assert len(images) == len(labels), "Data size error!"
         self.images = images
         self.labels = labels
+        # positions of the samples in images/labels when those are a whole source split (an index view), else None
+        self.indices = indices
         self.trsf = trsf
         self.use_path = use_path
+        # position of each sample in its source split, and the key its features can be cached under (None if not cacheable)
+        self.sample_ids = sample_ids
+        self.cache_key = cache_key
+        # rows of the images in the decoded image cache, if any
+        self.image_cache = image_cache if use_path else None
+        self.cache_rows = None
+        if self.image_cache is not None:
+            self.cache_rows = self.image_cache.rows(images if indices is None else images[indices])
+        # cached outputs of trsf, addressed by sample_ids
+        self.transform_cache = transform_cache
+        # batch-level transform the loaders have to collate with (None for the default collate)
+        self.collate_fn = collate_fn
 
     def __len__(self):
-        return len(self.images)
+        return len(self.images) if self.indices is None else len(self.indices)
 
     def __getitem__(self, idx):
-        if self.use_path:
-            image = self.trsf(pil_loader(self.images[idx]))
+        if self.transform_cache is not None:
+            image = self.transform_cache.load(self.sample_ids[idx], lambda: self._load_image(idx))
         else:
-            image = self.trsf(Image.fromarray(self.images[idx]))
-        label = self.labels[idx]
+            image = self.trsf(self._load_image(idx))
+        label = self.labels[idx if self.indices is None else self.indices[idx]]
 
         return idx, image, label
 
+    def _load_image(self, idx):
+        if self.image_cache is not None:
+            return self.image_cache.load(self.cache_rows[idx])
+        pos = idx if self.indices is None else self.indices[idx]
+        if self.use_path:
+            return pil_loader(self.images[pos])
+        return Image.fromarray(self.images[pos])
+
+    def __getstate__(self):
+        # other processes only receive the viewed samples, not the whole source split
+        state = self.__dict__.copy()
+        if self.indices is not None:
+            state["images"], state["labels"], state["indices"] = self.images[self.indices], self.labels[self.indices], None
+        return state
+
 
 def _map_new_class_index(y, order):
-    return np.array(list(map(lambda x: order.index(x), y)))
+    lookup = np.zeros(max(order) + 1, dtype=np.int64)
+    lookup[np.asarray(order)] = np.arange(len(order))
+    return lookup[np.asarray(y)]
+
+
+def _class_index(y, num_classes):
+    # stable sort keeps the samples of a class in ascending position, as np.where does
+    order = np.argsort(y, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(y, minlength=num_classes))])
+    return order, offsets
+
+
+def _take_classes(class_index, indices):
+    order, offsets = class_index
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+        return np.array([], dtype=np.int64)
+    if np.all(np.diff(indices) == 1):
+        return order[offsets[indices[0]]:offsets[indices[-1] + 1]]
+    return np.concatenate([order[offsets[c]:offsets[c + 1]] for c in indices])
 
 
 def _get_idata(dataset_name, args=None):
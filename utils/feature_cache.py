@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import os
+import numpy as np
+import torch
+
+# bumped whenever the layout or meaning of persisted feature rows changes
+FEATURE_CACHE_VERSION = 1
+
+
+def state_fingerprint(named_tensors):
+    """
+    Hash of named tensors, e.g. the frozen entries of a state_dict, telling apart caches of other weights.
+
+    Args:
+        named_tensors (iterable): (name, torch.Tensor) pairs.
+
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.sha1()
+    for name, tensor in sorted(named_tensors, key=lambda item: item[0]):
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update("{}:{}:{}\n".format(name, tuple(tensor.shape), tensor.dtype).encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+    return digest.hexdigest()
+
+
+class FeatureCache(object):
+    """
+    Feature table for one (dataset, split, transform, backbone) key.
+
+    Rows are addressed by the position of a sample in its source split and are filled lazily.
+    With a path the table is memory-mapped, so the same file can be reused across tasks, seeds and runs;
+    without one it lives in host memory for the current run only.
+    """
+    def __init__(self, path, num_samples, feature_dim):
+        if path is None:
+            self.features = np.zeros((num_samples, feature_dim), dtype=np.float32)
+            self.filled = np.zeros(num_samples, dtype=np.bool_)
+            return
+        mode = "r+" if os.path.exists(path + ".npy") and os.path.exists(path + ".filled.npy") else "w+"
+        self.features = np.lib.format.open_memmap(path + ".npy", mode=mode, dtype=np.float32, shape=(num_samples, feature_dim))
+        self.filled = np.lib.format.open_memmap(path + ".filled.npy", mode=mode, dtype=np.bool_, shape=(num_samples,))
+        if self.features.shape != (num_samples, feature_dim):
+            raise ValueError("Feature cache {} has shape {}, expected {}.".format(path, self.features.shape, (num_samples, feature_dim)))
+
+    def lookup(self, sample_ids):
+        """
+        Returns:
+            np.ndarray: Boolean hit mask [B]
+            np.ndarray: Cached features of the hits [num_hits, feature_dim]
+        """
+        hits = self.filled[sample_ids]
+        return hits, np.asarray(self.features[sample_ids[hits]])
+
+    def update(self, sample_ids, features):
+        self.features[sample_ids] = features
+        self.filled[sample_ids] = True
+
+    def flush(self):
+        if isinstance(self.features, np.memmap):
+            self.features.flush()
+            self.filled.flush()
+
+
+class FeatureStore(object):
+    """
+    FeatureCache tables for the features of frozen networks, one per dataset key and route.
+
+    A route tells apart several frozen networks sharing the store, e.g. the adapters of finished tasks.
+    The namespace should identify the weights the features come from (see state_fingerprint); the dataset
+    cache keys identify the samples. With root=None the tables are kept in host memory and dropped with the store.
+    """
+    def __init__(self, root, namespace):
+        self.root = root
+        self.namespace = namespace
+        self._caches = dict()
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+
+    def get(self, dataset, feature_dim, route=None):
+        # datasets built with random transforms or without source positions are not cacheable
+        cache_key = getattr(dataset, "cache_key", None)
+        if cache_key is None:
+            return None
+        if (cache_key, route) not in self._caches:
+            path = None
+            if self.root is not None:
+                digest = hashlib.sha1(repr((FEATURE_CACHE_VERSION, self.namespace, cache_key, route, feature_dim)).encode()).hexdigest()[:16]
+                path = os.path.join(self.root, "{}_{}_{}".format(cache_key[0], cache_key[1], digest))
+                logging.info("Feature cache for {} {}: {}.npy".format(cache_key[0], cache_key[1], path))
+            self._caches[(cache_key, route)] = FeatureCache(path, cache_key[2], feature_dim)
+        return self._caches[(cache_key, route)]
+
+    def lookup(self, dataset, idx, feature_dim, route=None):
+        """
+        Args:
+            dataset: The DummyDataset the batch was drawn from.
+            idx (torch.Tensor): Dataset-local indices of the samples, as yielded by the loader.
+
+        Returns:
+            np.ndarray: Boolean hit mask [B], or None if the dataset is not cacheable.
+            np.ndarray: Cached features of the hits [num_hits, feature_dim].
+        """
+        cache = self.get(dataset, feature_dim, route)
+        if cache is None:
+            return None, None
+        return cache.lookup(dataset.sample_ids[idx.cpu().numpy()])
+
+    def update(self, dataset, idx, features, route=None):
+        cache = self.get(dataset, features.shape[-1], route)
+        if cache is not None:
+            cache.update(dataset.sample_ids[idx.cpu().numpy()], features.float().cpu().numpy())
+
+    def flush(self):
+        for cache in self._caches.values():
+            cache.flush()
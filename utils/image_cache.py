@@ -0,0 +1,201 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+
+class ImageCache(object):
+    """
+    Decoded RGB images of a path-based dataset, resized once to a fixed short side and stored back to back
+    in one memory-mapped uint8 file, with an index of (offset, height, width) per image.
+
+    The index is keyed by the sorted image paths, so train and test splits, memory exemplars and every task
+    share one cache. The file is opened read-only and lazily in each process, so DataLoader workers read the
+    pixels straight from the page cache instead of decoding the source files.
+    """
+    def __init__(self, root, name, paths, loader, short_side=256, num_workers=None):
+        os.makedirs(root, exist_ok=True)
+        self.loader = loader
+        self.short_side = short_side
+        self.path = os.path.join(root, "{}_{}".format(name, short_side))
+        self.paths = np.unique(np.asarray(paths).astype(str))
+        if not self._load_index():
+            self._build(num_workers)
+        self._data = None
+
+    def _load_index(self):
+        if not (os.path.exists(self.path + ".bin") and os.path.exists(self.path + ".index.npz")):
+            return False
+        index = np.load(self.path + ".index.npz")
+        if not np.array_equal(index["paths"], self.paths):
+            logging.info("Image cache {} was built for other images, rebuilding.".format(self.path))
+            return False
+        self.offsets, self.shapes = index["offsets"], index["shapes"]
+        return True
+
+    def _resized_shape(self, path):
+        # the header is enough to size every row before decoding anything
+        with Image.open(path) as img:
+            w, h = img.size
+        scale = self.short_side / min(w, h)
+        return max(1, round(h * scale)), max(1, round(w * scale))
+
+    def _build(self, num_workers):
+        logging.info("Building image cache {} for {} images.".format(self.path, len(self.paths)))
+        with ThreadPoolExecutor(num_workers) as pool:
+            self.shapes = np.array(list(pool.map(self._resized_shape, self.paths)), dtype=np.int64).reshape(-1, 2)
+        sizes = self.shapes[:, 0] * self.shapes[:, 1] * 3
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+        data = np.memmap(self.path + ".bin", dtype=np.uint8, mode="w+", shape=(max(int(sizes.sum()), 1),))
+
+        def decode(row):
+            h, w = self.shapes[row]
+            img = self.loader(self.paths[row]).resize((int(w), int(h)), Image.BICUBIC)
+            data[self.offsets[row]:self.offsets[row] + sizes[row]] = np.asarray(img, dtype=np.uint8).reshape(-1)
+
+        # PIL releases the GIL while decoding and resampling
+        with ThreadPoolExecutor(num_workers) as pool:
+            list(pool.map(decode, range(len(self.paths))))
+        data.flush()
+        del data
+        # the index is written last, so an interrupted build is redone on the next run
+        np.savez(self.path + ".index.npz", paths=self.paths, offsets=self.offsets, shapes=self.shapes)
+
+    def rows(self, paths):
+        """
+        Args:
+            paths (np.ndarray): Image paths, all of them in the cache.
+
+        Returns:
+            np.ndarray: Cache row of each path.
+        """
+        paths = np.asarray(paths).astype(str)
+        rows = np.searchsorted(self.paths, paths)
+        if len(paths) > 0 and not np.array_equal(self.paths[np.minimum(rows, len(self.paths) - 1)], paths):
+            raise KeyError("Image cache {} does not hold all the requested images.".format(self.path))
+        return rows
+
+    def load(self, row):
+        if self._data is None:
+            self._data = np.memmap(self.path + ".bin", dtype=np.uint8, mode="r")
+        h, w = self.shapes[row]
+        start = self.offsets[row]
+        return Image.fromarray(self._data[start:start + h * w * 3].reshape(h, w, 3))
+
+    def __getstate__(self):
+        # workers reopen the file instead of receiving a copy of the mapping
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+
+class TransformCache(object):
+    """
+    uint8 outputs of a deterministic image transform for one (dataset, split, transform) key, one fixed-size
+    HxWx3 row per position in the source split, memory-mapped and filled lazily by whichever process first
+    loads a sample. Later tasks only fill the rows of their new classes.
+
+    The transform is split at its first ToTensor: the PIL part is cached, the tensor part (ToTensor and
+    e.g. Normalize) runs once per batch in collate_fn. The file is tied to a fingerprint of the source samples
+    and rebuilt when they change; a row is only marked filled once its pixels are on disk, so a killed run
+    never leaves filled rows without pixels.
+    """
+    def __init__(self, path, num_samples, trsf, fingerprint):
+        self.path = path
+        self.pixel_trsf, tensor_trsf, size = split_cacheable_transform(trsf)
+        self.collate_fn = CachedBatch(tensor_trsf)
+        self.shape = (num_samples, size[0], size[1], 3)
+        reuse = os.path.exists(path + ".npy") and os.path.exists(path + ".filled.npy")
+        if reuse and self._stored_fingerprint() != fingerprint:
+            logging.info("Transform cache {} was built for other samples, rebuilding.".format(path))
+            reuse = False
+        mode = "r+" if reuse else "w+"
+        pixels = np.lib.format.open_memmap(path + ".npy", mode=mode, dtype=np.uint8, shape=self.shape)
+        filled = np.lib.format.open_memmap(path + ".filled.npy", mode=mode, dtype=np.bool_, shape=(num_samples,))
+        if pixels.shape != self.shape:
+            raise ValueError("Transform cache {} has shape {}, expected {}.".format(path, pixels.shape, self.shape))
+        self._offsets = (pixels.offset, filled.offset)
+        self._row_bytes = int(np.prod(self.shape[1:]))
+        del pixels, filled
+        if not reuse:
+            # written last, so an interrupted rebuild is redone on the next run
+            with open(path + ".fingerprint", "w") as f:
+                f.write(fingerprint)
+        self._pixels, self._filled, self._fds = None, None, None
+
+    def _stored_fingerprint(self):
+        if not os.path.exists(self.path + ".fingerprint"):
+            return None
+        with open(self.path + ".fingerprint") as f:
+            return f.read()
+
+    def _open(self):
+        if self._pixels is None:
+            self._pixels = np.load(self.path + ".npy", mmap_mode="r")
+            self._filled = np.load(self.path + ".filled.npy", mmap_mode="r")
+            self._fds = (os.open(self.path + ".npy", os.O_WRONLY), os.open(self.path + ".filled.npy", os.O_WRONLY))
+
+    def load(self, row, image_loader):
+        """
+        Args:
+            row (int): Position of the sample in its source split.
+            image_loader (callable): Returns the PIL image of the sample, only called on a miss.
+
+        Returns:
+            torch.Tensor: The cached uint8 pixels [3, H, W], to be collated with collate_fn.
+        """
+        self._open()
+        if self._filled[row]:
+            pixels = np.array(self._pixels[row])
+        else:
+            pixels = np.ascontiguousarray(self.pixel_trsf(image_loader()), dtype=np.uint8)
+            # the pixels reach the file before the row is marked filled; the mappings see both writes
+            os.pwrite(self._fds[0], pixels.tobytes(), self._offsets[0] + row * self._row_bytes)
+            os.fdatasync(self._fds[0])
+            os.pwrite(self._fds[1], b"\x01", self._offsets[1] + row)
+        return torch.from_numpy(pixels).permute(2, 0, 1)
+
+    def __getstate__(self):
+        # workers reopen the files instead of receiving a copy of the mappings
+        state = self.__dict__.copy()
+        state["_pixels"], state["_filled"], state["_fds"] = None, None, None
+        return state
+
+
+class CachedBatch(object):
+    """
+    collate_fn of datasets served from a TransformCache: stacks the uint8 rows, converts them to float in [0, 1]
+    and applies the rest of the tensor part of the transform (e.g. Normalize) once for the whole batch.
+    """
+    def __init__(self, tensor_trsf=None):
+        self.tensor_trsf = tensor_trsf
+
+    def __call__(self, batch):
+        idx, images, labels = zip(*batch)
+        out = torch.stack(images).float().div_(255)
+        if self.tensor_trsf is not None:
+            out = self.tensor_trsf(out)
+        return torch.as_tensor(idx), out, torch.as_tensor(labels)
+
+
+def split_cacheable_transform(trsf):
+    """
+    Splits a Compose into its PIL part and the tensor steps after its first ToTensor.
+    Returns None if the PIL part does not end with a CenterCrop, i.e. its output size is not fixed.
+
+    Returns:
+        transforms.Compose: PIL part.
+        transforms.Compose: Tensor steps after ToTensor, or None if there are none.
+        tuple: (height, width) of the PIL part's output.
+    """
+    steps = list(trsf.transforms)
+    split = next((i for i, t in enumerate(steps) if isinstance(t, transforms.ToTensor)), None)
+    if split is None or split == 0 or not isinstance(steps[split - 1], transforms.CenterCrop):
+        return None
+    size = steps[split - 1].size
+    size = (size, size) if isinstance(size, int) else tuple(size)
+    tensor_trsf = transforms.Compose(steps[split + 1:]) if len(steps) > split + 1 else None
+    return transforms.Compose(steps[:split]), tensor_trsf, size
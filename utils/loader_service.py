@@ -0,0 +1,175 @@
+import logging
+import math
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+def _identity(batch):
+    return batch
+
+
+def _stage_path(root, stage_id):
+    return os.path.join(root, "stage_{}.pkl".format(stage_id))
+
+
+class _StageDataset(Dataset):
+    """
+    Maps (stage id, indices, live stage ids) to the collated batch of that stage's dataset.
+
+    Datasets registered before the workers start are inherited with the fork; later ones are read once per
+    worker from the pickle the service wrote at registration and kept in a small LRU cache. Every batch key
+    carries the stages still alive in the main process, so workers drop the datasets of released ones.
+    """
+    def __init__(self, root, max_cached=4):
+        self.root = root
+        self.max_cached = max_cached
+        self.registered = dict()
+        self._cached = OrderedDict()
+
+    def _dataset(self, stage_id):
+        if stage_id in self.registered:
+            return self.registered[stage_id]
+        if stage_id not in self._cached:
+            with open(_stage_path(self.root, stage_id), "rb") as f:
+                self._cached[stage_id] = pickle.load(f)
+            while len(self._cached) > self.max_cached:
+                self._cached.popitem(last=False)
+        self._cached.move_to_end(stage_id)
+        return self._cached[stage_id]
+
+    def _drop_released(self, live):
+        for stage_id in [s for s in self.registered if s not in live]:
+            del self.registered[stage_id]
+        for stage_id in [s for s in self._cached if s not in live]:
+            del self._cached[stage_id]
+
+    def __getitem__(self, key):
+        stage_id, indices, live = key
+        self._drop_released(live)
+        dataset = self._dataset(stage_id)
+        collate_fn = getattr(dataset, "collate_fn", None) or default_collate
+        return collate_fn([dataset[i] for i in indices])
+
+
+class _StageSampler(Sampler):
+    # yields the batches of whichever stage the service is iterating, tagged with the live stage ids
+    def __init__(self):
+        self.stage = None
+        self.live = frozenset()
+
+    def __iter__(self):
+        for stage_id, indices in self.stage.batches():
+            yield stage_id, indices, self.live
+
+    def __len__(self):
+        return len(self.stage)
+
+
+class StageLoader(object):
+    """
+    DataLoader-like view of one dataset, served by the workers of a LoaderService.
+    Iterating it yields the same (idx, inputs, targets) batches a DataLoader over the dataset would.
+    """
+    def __init__(self, service, dataset, batch_size, shuffle=False, drop_last=False):
+        self.service = service
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        # registered with the service on first iteration, so loaders that are never iterated cost nothing
+        self.stage_id = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def batches(self):
+        num_samples = len(self.dataset)
+        order = torch.randperm(num_samples).tolist() if self.shuffle else list(range(num_samples))
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            yield self.stage_id, order[start:start + self.batch_size]
+
+    def __iter__(self):
+        return self.service._iterate(self)
+
+
+class LoaderService(object):
+    """
+    One persistent DataLoader worker pool shared by every loader of a run.
+
+    Each dataset handed to loader() becomes a stage; iterating its StageLoader points the shared sampler at
+    it, so new tasks and stages reuse the running workers instead of forking a new pool per DataLoader.
+    Only one stage can be iterated at a time.
+    """
+    def __init__(self, num_workers=None, prefetch_factor=2, pin_memory=None):
+        if num_workers is None:
+            cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+            num_workers = min(8, cpus)
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        self.root = tempfile.mkdtemp(prefix="loader_service_", dir=shm)
+        weakref.finalize(self, shutil.rmtree, self.root, True)
+        self._dataset = _StageDataset(self.root)
+        self._sampler = _StageSampler()
+        self._loader = None
+        self._active = None
+        self._next_stage = 0
+        self._live = set()
+        logging.info("Loader service with {} workers, prefetch {}, pin_memory {}.".format(
+            num_workers, prefetch_factor, self.pin_memory))
+
+    def loader(self, dataset, batch_size, shuffle=False, drop_last=False):
+        return StageLoader(self, dataset, batch_size, shuffle=shuffle, drop_last=drop_last)
+
+    def _register(self, stage):
+        stage_id = self._next_stage
+        self._next_stage += 1
+        self._dataset.registered[stage_id] = stage.dataset
+        self._live.add(stage_id)
+        if self._loader is not None and self.num_workers > 0:
+            # running workers did not inherit this stage
+            with open(_stage_path(self.root, stage_id), "wb") as f:
+                pickle.dump(stage.dataset, f, protocol=pickle.HIGHEST_PROTOCOL)
+        stage.stage_id = stage_id
+        weakref.finalize(stage, self._release, stage_id)
+
+    def _release(self, stage_id):
+        self._dataset.registered.pop(stage_id, None)
+        self._live.discard(stage_id)
+        if os.path.exists(_stage_path(self.root, stage_id)):
+            os.remove(_stage_path(self.root, stage_id))
+
+    def _build_loader(self):
+        kwargs = dict()
+        if self.num_workers > 0:
+            kwargs = dict(persistent_workers=True, prefetch_factor=self.prefetch_factor)
+        return DataLoader(
+            self._dataset, batch_size=None, sampler=self._sampler, num_workers=self.num_workers,
+            collate_fn=_identity, pin_memory=self.pin_memory, **kwargs
+        )
+
+    def _iterate(self, stage):
+        if self._active is not None:
+            raise RuntimeError("Loader service is still iterating another stage.")
+        if stage.stage_id is None:
+            self._register(stage)
+        if self._loader is None:
+            # the workers fork on the first iteration and inherit the stages registered so far
+            self._loader = self._build_loader()
+        self._sampler.stage = stage
+        self._sampler.live = frozenset(self._live)
+        self._active = stage
+        try:
+            yield from self._loader
+        finally:
+            self._active = None
@@ -24,243 +24,121 @@ def makedirs(path):
         os.makedirs(path)
 
 
-def accuracy(y_pred, y_true, nb_old, init_cls=10, increment=10):
-    assert len(y_pred) == len(y_true), "Data length error."
-    all_acc = {}
-    all_acc["total"] = np.around(
-        (y_pred == y_true).sum() * 100 / len(y_true), decimals=2
-    )
-
-    # Grouped accuracy, for initial classes
-    idxes = np.where(
-        np.logical_and(y_true >= 0, y_true < init_cls)
-    )[0]
-    label = "{}-{}".format(
-        str(0).rjust(2, "0"), str(init_cls - 1).rjust(2, "0")
-    )
-    all_acc[label] = np.around(
-        (y_pred[idxes] == y_true[idxes]).sum() * 100 / len(idxes), decimals=2
-    )
-    # for incremental classes
-    for class_id in range(init_cls, np.max(y_true), increment):
-        idxes = np.where(
-            np.logical_and(y_true >= class_id, y_true < class_id + increment)
-        )[0]
-        label = "{}-{}".format(
-            str(class_id).rjust(2, "0"), str(class_id + increment - 1).rjust(2, "0")
-        )
-        all_acc[label] = np.around(
-            (y_pred[idxes] == y_true[idxes]).sum() * 100 / len(idxes), decimals=2
-        )
-
-    # Old accuracy
-    idxes = np.where(y_true < nb_old)[0]
-
-    all_acc["old"] = (
-        0
-        if len(idxes) == 0
-        else np.around(
-            (y_pred[idxes] == y_true[idxes]).sum() * 100 / len(idxes), decimals=2
-        )
-    )
-
-    # New accuracy
-    idxes = np.where(y_true >= nb_old)[0]
-    all_acc["new"] = np.around(
-        (y_pred[idxes] == y_true[idxes]).sum() * 100 / len(idxes), decimals=2
-    )
-
-    return all_acc
-
-from sklearn.metrics import f1_score
-
-def f1_score_custom(y_pred, y_true, nb_old, init_cls=10, increment=10):
-    assert len(y_pred) == len(y_true), "Data length error."
-    all_f1 = {}
-
-    # Total F1 score
-    all_f1["total"] = np.around(f1_score(y_true, y_pred, average='weighted'), decimals=2)
+class ConfusionMetrics(object):
+    """
+    Confusion matrix of one prediction run, built once with np.bincount.
+
+    Every metric of every class group (total, initial/incremental blocks, old, new) is derived from the
+    row block of the groups' true classes, so scoring costs O(C^2) per group instead of a pass over N.
+    """
+    METRICS = ["accuracy", "f1_score", "mcc", "kappa", "balanced_accuracy"]
+
+    def __init__(self, y_pred, y_true, nb_classes=None):
+        assert len(y_pred) == len(y_true), "Data length error."
+        y_pred = np.asarray(y_pred, dtype=np.int64)
+        y_true = np.asarray(y_true, dtype=np.int64)
+        if nb_classes is None:
+            nb_classes = int(max(y_pred.max(initial=0), y_true.max(initial=0))) + 1
+        self.nb_classes = nb_classes
+        self.max_true = int(y_true.max(initial=0))
+        self.cm = np.bincount(
+            y_true * nb_classes + y_pred, minlength=nb_classes * nb_classes
+        ).reshape(nb_classes, nb_classes).astype(np.float64)
+
+    def _block(self, low, high):
+        # per-class true positives, support and predicted counts restricted to samples with y_true in [low, high)
+        low, high = max(low, 0), min(high, self.nb_classes)
+        tp = np.zeros(self.nb_classes)
+        support = np.zeros(self.nb_classes)
+        if high <= low:
+            return tp, support, np.zeros(self.nb_classes)
+        rows = self.cm[low:high]
+        tp[low:high] = np.diagonal(rows[:, low:high])
+        support[low:high] = rows.sum(axis=1)
+        return tp, support, rows.sum(axis=0)
+
+    def score(self, metric, low, high):
+        tp, support, predicted = self._block(low, high)
+        n = support.sum()
+        if n == 0:
+            return 0
+        correct = tp.sum()
+
+        if metric == "accuracy":
+            return np.around(correct * 100 / n, decimals=2)
+
+        if metric == "f1_score":
+            # support-weighted F1, as sklearn's average='weighted'
+            denom = support + predicted
+            f1 = np.divide(2 * tp, denom, out=np.zeros_like(tp), where=denom > 0)
+            return np.around((support * f1).sum() / n, decimals=2)
+
+        if metric == "mcc":
+            cov_ytyp = correct * n - predicted @ support
+            cov_ypyp = n * n - predicted @ predicted
+            cov_ytyt = n * n - support @ support
+            if cov_ypyp * cov_ytyt == 0:
+                return 0.0
+            return np.around(cov_ytyp / np.sqrt(cov_ytyt * cov_ypyp), decimals=2)
+
+        if metric == "kappa":
+            expected = predicted @ support / n
+            with np.errstate(divide="ignore", invalid="ignore"):
+                kappa = 1 - np.float64(n - correct) / np.float64(n - expected)
+            return np.around(kappa, decimals=2)
+
+        if metric == "balanced_accuracy":
+            # mean one-vs-rest 0.5 * (TPR + TNR) over the labels present in y_true or y_pred
+            labels = (support > 0) | (predicted > 0)
+            fn = support - tp
+            fp = predicted - tp
+            tn = n - (tp + fn + fp)
+            eps = np.finfo(float).eps
+            balanced = 0.5 * (tp / np.maximum(tp + fn, eps) + tn / np.maximum(tn + fp, eps))
+            return np.around(np.mean(balanced[labels]), decimals=2)
+
+        raise ValueError("Unknown metric {}.".format(metric))
+
+    def grouped(self, metric, nb_old, init_cls=10, increment=10):
+        ret = {}
+        ret["total"] = self.score(metric, 0, self.nb_classes)
+
+        # Grouped scores, for initial classes
+        label = "{}-{}".format(str(0).rjust(2, "0"), str(init_cls - 1).rjust(2, "0"))
+        ret[label] = self.score(metric, 0, init_cls)
+        # for incremental classes
+        stop = self.max_true + 1 if metric == "balanced_accuracy" else self.max_true
+        for class_id in range(init_cls, stop, increment):
+            label = "{}-{}".format(
+                str(class_id).rjust(2, "0"), str(class_id + increment - 1).rjust(2, "0")
+            )
+            ret[label] = self.score(metric, class_id, class_id + increment)
 
-    # Grouped F1 score for initial classes
-    idxes = np.where(np.logical_and(y_true >= 0, y_true < init_cls))[0]
-    label = "{}-{}".format(str(0).rjust(2, "0"), str(init_cls - 1).rjust(2, "0"))
-    all_f1[label] = np.around(f1_score(y_true[idxes], y_pred[idxes], average='weighted'), decimals=2)
+        # Old and new classes
+        ret["old"] = self.score(metric, 0, nb_old)
+        ret["new"] = self.score(metric, nb_old, self.nb_classes)
 
-    # For incremental classes
-    for class_id in range(init_cls, np.max(y_true), increment):
-        idxes = np.where(np.logical_and(y_true >= class_id, y_true < class_id + increment))[0]
-        label = "{}-{}".format(str(class_id).rjust(2, "0"), str(class_id + increment - 1).rjust(2, "0"))
-        all_f1[label] = np.around(f1_score(y_true[idxes], y_pred[idxes], average='weighted'), decimals=2)
+        return ret
 
-    # Old F1 score
-    idxes = np.where(y_true < nb_old)[0]
-    all_f1["old"] = 0 if len(idxes) == 0 else np.around(f1_score(y_true[idxes], y_pred[idxes], average='weighted'), decimals=2)
 
-    # New F1 score
-    idxes = np.where(y_true >= nb_old)[0]
-    all_f1["new"] = np.around(f1_score(y_true[idxes], y_pred[idxes], average='weighted'), decimals=2)
+def accuracy(y_pred, y_true, nb_old, init_cls=10, increment=10):
+    return ConfusionMetrics(y_pred, y_true).grouped("accuracy", nb_old, init_cls, increment)
 
-    return all_f1
 
+def f1_score_custom(y_pred, y_true, nb_old, init_cls=10, increment=10):
+    return ConfusionMetrics(y_pred, y_true).grouped("f1_score", nb_old, init_cls, increment)
 
-from sklearn.metrics import matthews_corrcoef
-import numpy as np
 
 def mcc_score_custom(y_pred, y_true, nb_old, init_cls=10, increment=10):
-    assert len(y_pred) == len(y_true), "Data length error."
-    all_mcc = {}
-
-    # Total MCC score
-    all_mcc["total"] = np.around(matthews_corrcoef(y_true, y_pred), decimals=2)
-
-    # Grouped MCC score for initial classes
-    idxes = np.where(np.logical_and(y_true >= 0, y_true < init_cls))[0]
-    label = "{}-{}".format(str(0).rjust(2, "0"), str(init_cls - 1).rjust(2, "0"))
-    all_mcc[label] = np.around(matthews_corrcoef(y_true[idxes], y_pred[idxes]), decimals=2)
-
-    # For incremental classes
-    for class_id in range(init_cls, np.max(y_true), increment):
-        idxes = np.where(np.logical_and(y_true >= class_id, y_true < class_id + increment))[0]
-        label = "{}-{}".format(str(class_id).rjust(2, "0"), str(class_id + increment - 1).rjust(2, "0"))
-        all_mcc[label] = np.around(matthews_corrcoef(y_true[idxes], y_pred[idxes]), decimals=2)
-
-    # Old MCC score
-    idxes = np.where(y_true < nb_old)[0]
-    all_mcc["old"] = 0 if len(idxes) == 0 else np.around(matthews_corrcoef(y_true[idxes], y_pred[idxes]), decimals=2)
+    return ConfusionMetrics(y_pred, y_true).grouped("mcc", nb_old, init_cls, increment)
 
-    # New MCC score
-    idxes = np.where(y_true >= nb_old)[0]
-    all_mcc["new"] = np.around(matthews_corrcoef(y_true[idxes], y_pred[idxes]), decimals=2)
-
-    return all_mcc
-
-from sklearn.metrics import cohen_kappa_score
 
 def kappa_score_custom(y_pred, y_true, nb_old, init_cls=10, increment=10):
-    assert len(y_pred) == len(y_true), "Data length error."
-    all_kappa = {}
-
-    # Total Kappa score
-    all_kappa["total"] = np.around(cohen_kappa_score(y_true, y_pred), decimals=2)
-
-    # Grouped Kappa score for initial classes
-    idxes = np.where(np.logical_and(y_true >= 0, y_true < init_cls))[0]
-    label = "{}-{}".format(str(0).rjust(2, "0"), str(init_cls - 1).rjust(2, "0"))
-    all_kappa[label] = np.around(cohen_kappa_score(y_true[idxes], y_pred[idxes]), decimals=2)
-
-    # For incremental classes
-    for class_id in range(init_cls, np.max(y_true), increment):
-        idxes = np.where(np.logical_and(y_true >= class_id, y_true < class_id + increment))[0]
-        label = "{}-{}".format(str(class_id).rjust(2, "0"), str(class_id + increment - 1).rjust(2, "0"))
-        all_kappa[label] = np.around(cohen_kappa_score(y_true[idxes], y_pred[idxes]), decimals=2)
-
-    # Old Kappa score
-    idxes = np.where(y_true < nb_old)[0]
-    all_kappa["old"] = 0 if len(idxes) == 0 else np.around(cohen_kappa_score(y_true[idxes], y_pred[idxes]), decimals=2)
+    return ConfusionMetrics(y_pred, y_true).grouped("kappa", nb_old, init_cls, increment)
 
-    # New Kappa score
-    idxes = np.where(y_true >= nb_old)[0]
-    all_kappa["new"] = np.around(cohen_kappa_score(y_true[idxes], y_pred[idxes]), decimals=2)
-
-    return all_kappa
-
-from sklearn.metrics import confusion_matrix
 
 def balanced_accuracy_custom(y_pred, y_true, nb_old, init_cls=10, increment=10):
-    assert len(y_pred) == len(y_true), "Data length error."
-    all_balanced_acc = {}
-
-    # Total Balanced Accuracy
-    cm = confusion_matrix(y_true, y_pred)
-    tp = np.diag(cm)
-    fn = cm.sum(axis=1) - tp
-    fp = cm.sum(axis=0) - tp
-    tn = cm.sum() - (tp + fn + fp)
-
-    # Handle potential division by zero
-    balanced_accuracy_total = 0.5 * (
-        (tp / np.maximum(tp + fn, np.finfo(float).eps)) +
-        (tn / np.maximum(tn + fp, np.finfo(float).eps))
-    )
-    all_balanced_acc["total"] = np.around(np.mean(balanced_accuracy_total), decimals=2)
-
-    # Grouped Balanced Accuracy for initial classes
-    idxes = np.where(np.logical_and(y_true >= 0, y_true < init_cls))[0]
-    if len(idxes) > 0:
-        cm_init = confusion_matrix(y_true[idxes], y_pred[idxes])
-        tp_init = np.diag(cm_init)
-        fn_init = cm_init.sum(axis=1) - tp_init
-        fp_init = cm_init.sum(axis=0) - tp_init
-        tn_init = cm_init.sum() - (tp_init + fn_init + fp_init)
-
-        # Handle potential division by zero
-        balanced_accuracy_init = 0.5 * (
-            (tp_init / np.maximum(tp_init + fn_init, np.finfo(float).eps)) +
-            (tn_init / np.maximum(tn_init + fp_init, np.finfo(float).eps))
-        )
-        label_init = "{}-{}".format(str(0).rjust(2, "0"), str(init_cls - 1).rjust(2, "0"))
-        all_balanced_acc[label_init] = np.around(np.mean(balanced_accuracy_init), decimals=2)
-    else:
-        all_balanced_acc["init"] = 0
-
-    # For incremental classes
-    for class_id in range(init_cls, np.max(y_true) + 1, increment):
-        idxes = np.where(np.logical_and(y_true >= class_id, y_true < class_id + increment))[0]
-        if len(idxes) > 0:
-            cm_increment = confusion_matrix(y_true[idxes], y_pred[idxes])
-            tp_increment = np.diag(cm_increment)
-            fn_increment = cm_increment.sum(axis=1) - tp_increment
-            fp_increment = cm_increment.sum(axis=0) - tp_increment
-            tn_increment = cm_increment.sum() - (tp_increment + fn_increment + fp_increment)
-
-            # Handle potential division by zero
-            balanced_accuracy_increment = 0.5 * (
-                (tp_increment / np.maximum(tp_increment + fn_increment, np.finfo(float).eps)) +
-                (tn_increment / np.maximum(tn_increment + fp_increment, np.finfo(float).eps))
-            )
-            label_increment = "{}-{}".format(str(class_id).rjust(2, "0"), str(class_id + increment - 1).rjust(2, "0"))
-            all_balanced_acc[label_increment] = np.around(np.mean(balanced_accuracy_increment), decimals=2)
-        else:
-            all_balanced_acc[f"{class_id}-{class_id + increment - 1}"] = 0
-
-    # Old Balanced Accuracy
-    idxes = np.where(y_true < nb_old)[0]
-    if len(idxes) > 0:
-        cm_old = confusion_matrix(y_true[idxes], y_pred[idxes])
-        tp_old = np.diag(cm_old)
-        fn_old = cm_old.sum(axis=1) - tp_old
-        fp_old = cm_old.sum(axis=0) - tp_old
-        tn_old = cm_old.sum() - (tp_old + fn_old + fp_old)
-
-        # Handle potential division by zero
-        balanced_accuracy_old = 0.5 * (
-            (tp_old / np.maximum(tp_old + fn_old, np.finfo(float).eps)) +
-            (tn_old / np.maximum(tn_old + fp_old, np.finfo(float).eps))
-        )
-        all_balanced_acc["old"] = np.around(np.mean(balanced_accuracy_old), decimals=2)
-    else:
-        all_balanced_acc["old"] = 0
-
-    # New Balanced Accuracy
-    idxes = np.where(y_true >= nb_old)[0]
-    if len(idxes) > 0:
-        cm_new = confusion_matrix(y_true[idxes], y_pred[idxes])
-        tp_new = np.diag(cm_new)
-        fn_new = cm_new.sum(axis=1) - tp_new
-        fp_new = cm_new.sum(axis=0) - tp_new
-        tn_new = cm_new.sum() - (tp_new + fn_new + fp_new)
-
-        # Handle potential division by zero
-        balanced_accuracy_new = 0.5 * (
-            (tp_new / np.maximum(tp_new + fn_new, np.finfo(float).eps)) +
-            (tn_new / np.maximum(tn_new + fp_new, np.finfo(float).eps))
-        )
-        all_balanced_acc["new"] = np.around(np.mean(balanced_accuracy_new), decimals=2)
-    else:
-        all_balanced_acc["new"] = 0
-
-    return all_balanced_acc
-
+    return ConfusionMetrics(y_pred, y_true).grouped("balanced_accuracy", nb_old, init_cls, increment)
 
 
 def split_images_labels(imgs):
@@ -272,3 +150,82 @@ def split_images_labels(imgs):
         labels.append(item[1])
 
     return np.array(images), np.array(labels)
+
+
+def _dist_to_centers(features, groups, centers, chunk_size=2048):
+    # squared distance of every row to the centers of its own group [N, K]
+    dists = []
+    for start in range(0, features.shape[0], chunk_size):
+        x = features[start:start + chunk_size]
+        c = centers[groups[start:start + chunk_size]]
+        dists.append((x.unsqueeze(1) - c).pow(2).sum(dim=-1))
+    return torch.cat(dists, dim=0)
+
+
+def _segment_argmin(keys, groups, num_groups):
+    # index of the smallest key of every group
+    order = torch.argsort(keys)
+    positions = torch.arange(keys.shape[0], device=keys.device)
+    first = torch.full((num_groups,), keys.shape[0], dtype=torch.long, device=keys.device)
+    first = first.scatter_reduce(0, groups[order], positions, reduce="amin")
+    return order[first.clamp(max=keys.shape[0] - 1)]
+
+
+@torch.no_grad()
+def batched_kmeans(features, groups, num_groups, n_clusters, n_iter=100, batch_size=None, tol=1e-4):
+    """
+    k-means run independently on every group of rows (e.g. every class of a task) in one vectorized pass,
+    with k-means++ seeding. Groups larger than batch_size are updated from random mini-batches of about
+    batch_size rows per iteration, smaller ones with full Lloyd steps.
+
+    Args:
+        features (torch.Tensor): Rows of all groups [N, D]
+        groups (torch.Tensor): Group of each row, in [0, num_groups) [N]
+
+    Returns:
+        torch.Tensor: Mean of the rows assigned to each cluster (its center if empty) [num_groups, n_clusters, D]
+        torch.Tensor: Variance of the rows assigned to each cluster (zero if empty) [num_groups, n_clusters, D]
+    """
+    features = features.float()
+    num_rows, dim = features.shape
+    group_size = torch.bincount(groups, minlength=num_groups).float()
+
+    # k-means++ seeding, one center per group and step, drawn with probability proportional to the squared distance
+    centers = torch.zeros(num_groups, n_clusters, dim, device=features.device)
+    min_dist = torch.ones(num_rows, device=features.device)
+    for k in range(n_clusters):
+        keys = torch.empty_like(min_dist).exponential_() / min_dist
+        centers[:, k] = features[_segment_argmin(keys, groups, num_groups)]
+        dist = (features - centers[groups, k]).pow(2).sum(dim=1)
+        min_dist = dist if k == 0 else torch.minimum(min_dist, dist)
+
+    full_batch = torch.ones(num_groups, dtype=torch.bool, device=features.device)
+    if batch_size is not None:
+        full_batch = group_size <= batch_size
+        keep_prob = (batch_size / group_size.clamp(min=1)).clamp(max=1)[groups]
+    seen = torch.zeros(num_groups * n_clusters, device=features.device)
+    tol = tol * features.var(dim=0).mean()
+    for _ in range(n_iter):
+        rows = torch.arange(num_rows, device=features.device)
+        if not bool(full_batch.all()):
+            rows = rows[torch.rand(num_rows, device=features.device) < keep_prob]
+        assign = _dist_to_centers(features[rows], groups[rows], centers).argmin(dim=1)
+        ids = groups[rows] * n_clusters + assign
+        sums = torch.zeros(num_groups * n_clusters, dim, device=features.device).index_add_(0, ids, features[rows])
+        counts = torch.bincount(ids, minlength=num_groups * n_clusters).float()
+        # Lloyd step for full-batch groups, per-center learning rate 1 / (rows seen) for mini-batch ones
+        seen = torch.where(full_batch.repeat_interleave(n_clusters), counts, seen + counts)
+        flat_centers = centers.view(-1, dim)
+        shift = (sums - counts.unsqueeze(1) * flat_centers) / seen.clamp(min=1).unsqueeze(1)
+        centers = (flat_centers + shift).view(num_groups, n_clusters, dim)
+        if shift.pow(2).sum(dim=1).view(num_groups, n_clusters).sum(dim=1).max() <= tol:
+            break
+
+    # statistics of the final assignment over all rows
+    ids = groups * n_clusters + _dist_to_centers(features, groups, centers).argmin(dim=1)
+    counts = torch.bincount(ids, minlength=num_groups * n_clusters).float().unsqueeze(1)
+    sums = torch.zeros(num_groups * n_clusters, dim, device=features.device).index_add_(0, ids, features)
+    means = torch.where(counts > 0, sums / counts.clamp(min=1), centers.view(-1, dim))
+    sq_dev = torch.zeros_like(sums).index_add_(0, ids, (features - means[ids]).pow(2))
+    variances = sq_dev / counts.clamp(min=1)
+    return means.view(num_groups, n_clusters, dim), variances.view(num_groups, n_clusters, dim)